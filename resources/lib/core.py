@@ -18,8 +18,9 @@ from .ui.resolution_selector import ResolutionSelector
 from .network import http_requester
 from .accounts.account import Account
 from .accounts.account_manager import AccountManager
-from .threadpool.threadpool import ThreadPool
-from .google_api.google_drive import GoogleDrive
+from .threadpool.threadpool import PRIORITY_HIGH, ThreadPool
+from .google_api.google_drive import GoogleDrive, ListingError
+from .google_api.query_planner import getParentsQuery
 from .sync.sync_cache_manager import SyncCacheManager
 from .filesystem.fs_helpers import removeProhibitedFSchars
 from .filesystem.fs_constants import TMDB_LANGUAGES, TMDB_REGIONS
@@ -399,13 +400,16 @@ class Core:
 		self.refreshToken(account.expiry)
 		sharedWithMe = self.settings.getParameter("shared_with_me")
 		starred = self.settings.getParameter("starred")
-		return self.cloudService.listDirectory(folderID=folderID, sharedWithMe=sharedWithMe, foldersOnly=True, starred=starred, search=search)
 
-	def getSpecificFolders(self, searchQuery, folders, folderIDs, threadCount):
+		try:
+			return self.cloudService.listDirectory(folderID=folderID, sharedWithMe=sharedWithMe, foldersOnly=True, starred=starred, search=search)
+		except ListingError:
+			return []
+
+	def getSpecificFolders(self, searchQuery, folders, folderIDs):
 
 		def getFolders(query):
-			folders_ = self.cloudService.listDirectory(customQuery=query)
-			filterFolders(folders_, folders, searchQuery, folderIDs)
+			return self.cloudService.listDirectory(customQuery=query, foldersOnly=True)
 
 		def filterFolders(folders_, folders, searchQuery, folderIDs):
 
@@ -422,14 +426,22 @@ class Core:
 
 		while folderIDs:
 			ids = folderIDs[:maxIDs]
-			queries.append(("mimeType='application/vnd.google-apps.folder' and not trashed and (" + " or ".join(f"'{id}' in parents" for id in ids) + ")",))
+			queries.append((getParentsQuery(ids, foldersOnly=True),))
 			folderIDs = folderIDs[maxIDs:]
 
-		with ThreadPool(threadCount) as pool:
-			pool.map(getFolders, queries)
+		with ThreadPool(PRIORITY_HIGH) as pool:
+
+			for future in pool.map(getFolders, queries):
+
+				try:
+					folders_ = future.result()
+				except Exception:
+					continue
+
+				filterFolders(folders_, folders, searchQuery, folderIDs)
 
 		if folderIDs:
-			self.getSpecificFolders(searchQuery, folders, folderIDs, threadCount)
+			self.getSpecificFolders(searchQuery, folders, folderIDs)
 
 	def getSyncSettings(self):
 		driveID = self.settings.getParameter("drive_id")
@@ -645,8 +657,13 @@ class Core:
 			"file_id": fileID,
 			"transcoded": transcoded,
 		}
-		http_requester.request(url, data)
-		item = xbmcgui.ListItem(path=f"http://localhost:{serverPort}/play")
+		session = http_requester.request(url, data)
+
+		if not isinstance(session, dict) or not session.get("session_id"):
+			return
+
+		sessionID = session["session_id"]
+		item = xbmcgui.ListItem(path=f"http://localhost:{serverPort}/play/{sessionID}")
 
 		if self.settings.getSetting("subtitles_format") == "Subtitles are named the same as STRM":
 			subtitles = glob.glob(glob.escape(filePath.rstrip(".strm")) + "*[!gom]")
@@ -657,7 +674,7 @@ class Core:
 
 		xbmcplugin.setResolvedUrl(self.pluginHandle, True, item)
 		url = f"http://localhost:{serverPort}/start_player"
-		data = {"db_id": dbID, "db_type": dbType}
+		data = {"db_id": dbID, "db_type": dbType, "session_id": sessionID}
 		http_requester.request(url, data)
 
 	def refreshToken(self, expiry):
@@ -731,8 +748,7 @@ class Core:
 
 		folders = []
 		folderIDs = [folderID]
-		threadCount = self.settings.getSettingInt("thread_count", 1)
-		self.getSpecificFolders(searchQuery, folders, folderIDs, threadCount)
+		self.getSpecificFolders(searchQuery, folders, folderIDs)
 		self.listFolders(driveID, folders)
 
 	def setAffix(self, affix):
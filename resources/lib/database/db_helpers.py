@@ -1,2 +1,45 @@
+# stay under SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds (999)
+MAX_VARIABLES = 900
+
+
+class Subquery:
+
+	def __init__(self, query, params=()):
+		self.query = query
+		self.params = list(params)
+
+
 def joinConditions(data):
-	return "WHERE " + " AND ".join([f'{k}="{v}"' if str(v)[0] != "(" else f"{k}={v}" for k, v in data.items()])
+	# returns a WHERE clause with ? placeholders and its parameters > the SQL text only depends on the columns
+	# so sqlite can reuse the prepared statement, and values are never interpolated into the query
+	clauses, params = [], []
+
+	for column, value in data.items():
+
+		if isinstance(value, Subquery):
+			clauses.append(f"{column} = ({value.query})")
+			params += value.params
+		elif isinstance(value, (list, tuple, set)):
+			clauses.append(f"{column} IN ({', '.join('?' * len(value))})")
+			params += list(value)
+		elif value is None:
+			clauses.append(f"{column} IS NULL")
+		else:
+			clauses.append(f"{column} = ?")
+			params.append(value)
+
+	return "WHERE " + " AND ".join(clauses), params
+
+def splitConditions(data, size=MAX_VARIABLES):
+	# breaks a condition with a long IN (...) list into several conditions that fit the variable limit
+	for column, value in data.items():
+
+		if isinstance(value, (list, tuple, set)) and len(value) > size:
+			value = list(value)
+
+			for idx in range(0, len(value), size):
+				yield {**data, column: value[idx:idx + size]}
+
+			return
+
+	yield data
@@ -1,124 +1,365 @@
+import re
 import sqlite3
 import threading
+import contextlib
 
-from .db_helpers import joinConditions
+from .db_helpers import joinConditions, splitConditions
+
+
+class ConnectionManager:
+	managers = {}
+	managersLock = threading.Lock()
+
+	def __init__(self, database, walMode):
+		self.database = database
+		self.walMode = walMode
+		self.connections = {}
+		self.lock = threading.Lock()
+		self.writeLock = threading.RLock()
+		# per thread unit of work: transaction depth, buffered (query, [params, ...]) groups and the tables they touch
+		self.local = threading.local()
+
+	@classmethod
+	def get(cls, database, walMode=False):
+		# every DatabaseManager of the same database file shares its connections and writer lock
+
+		with cls.managersLock:
+			manager = cls.managers.get(database)
+
+			if not manager:
+				manager = cls.managers[database] = cls(database, walMode)
+
+			return manager
+
+	def close(self):
+
+		with self.lock:
+			connections, self.connections = self.connections, {}
+
+		for conn in connections.values():
+			self._close(conn)
+
+	def connection(self):
+		thread = threading.current_thread()
+		conn = self.connections.get(thread)
+
+		if conn:
+			return conn
+
+		conn = sqlite3.connect(self.database, check_same_thread=False, timeout=15, cached_statements=256)
+		conn.row_factory = sqlite3.Row
+
+		if self.walMode:
+			# readers no longer block on the writer and commits only append to the log
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("PRAGMA synchronous=NORMAL")
+
+		with self.lock:
+			# connections of finished worker threads would otherwise pile up
+			deadThreads = [t for t in self.connections if not t.is_alive()]
+			deadConnections = [self.connections.pop(t) for t in deadThreads]
+			self.connections[thread] = conn
+
+		for deadConn in deadConnections:
+			self._close(deadConn)
+
+		return conn
+
+	def unitOfWork(self):
+		unit = self.local
+
+		if not hasattr(unit, "depth"):
+			unit.depth = 0
+			unit.statements = []
+			unit.tables = set()
+
+		return unit
+
+	@staticmethod
+	def _close(conn):
+
+		try:
+			conn.close()
+		except sqlite3.Error:
+			pass
 
 
 class DatabaseManager:
 
-	def __init__(self, database):
+	def __init__(self, database, walMode=False):
 		self.database = database
-		self.dbLock = threading.Lock()
+		self.connectionManager = ConnectionManager.get(database, walMode)
+		self.dbLock = self.connectionManager.writeLock
 
-	def lock(func):
+	def read(func):
+
+		def wrapper(self, *args, **kwargs):
+
+			try:
+				return func(self, *args, **kwargs)
+			except sqlite3.Error:
+				return
+
+		return wrapper
+
+	def write(func):
 
 		def wrapper(self, *args, **kwargs):
 
 			with self.dbLock:
+				conn = self._connect()
 
 				try:
-					return func(self, *args, **kwargs)
+					result = func(self, *args, **kwargs)
+					conn.commit()
+					return result
 				except sqlite3.Error:
-					return
+
+					try:
+						conn.rollback()
+					except sqlite3.Error:
+						pass
 
 		return wrapper
 
-	@lock
+	def closeConnections(self):
+		self.connectionManager.close()
+
+	def discard(self):
+		unit = self.connectionManager.unitOfWork()
+		unit.statements, unit.tables = [], set()
+
+	def flush(self):
+		unit = self.connectionManager.unitOfWork()
+
+		if not unit.statements:
+			return
+
+		statements = unit.statements
+		unit.statements, unit.tables = [], set()
+
+		with self.dbLock:
+			conn = self._connect()
+
+			try:
+
+				for query, paramsList in statements:
+					conn.executemany(query, paramsList)
+
+				conn.commit()
+			except sqlite3.Error:
+
+				try:
+					conn.rollback()
+				except sqlite3.Error:
+					pass
+
+	@contextlib.contextmanager
+	def transaction(self):
+		# writes made by this thread inside the block are buffered and committed together, runs of the same
+		# statement going through one executemany. reading a table with buffered writes flushes them first so
+		# the thread sees its own changes > other threads don't until flush() is called. a block that raises
+		# drops whatever is still buffered > writes flushed inside the block before that stay committed
+		unit = self.connectionManager.unitOfWork()
+		unit.depth += 1
+
+		try:
+			yield self
+		except BaseException:
+			unit.depth -= 1
+
+			if not unit.depth:
+				self.discard()
+
+			raise
+
+		unit.depth -= 1
+
+		if not unit.depth:
+			self.flush()
+
+	@read
 	def count(self, table, condition):
-		condition = joinConditions(condition)
-		query = f"SELECT COUNT(*) FROM {table} {condition}"
-		self._connect()
-		self.cursor.execute(query)
-		count = self.cursor.fetchone()
-		self._close()
-		return count[0] if count else 0
-
-	@lock
+		total = 0
+
+		for condition in splitConditions(condition):
+			condition, params = joinConditions(condition)
+			query = f"SELECT COUNT(*) FROM {table} {condition}"
+			count = self._fetchOne(query, params)
+			total += count[0] if count else 0
+
+		return total
+
+	@write
+	def createIndex(self, name, table, columns):
+		query = f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+		self._execute(query)
+
+	@write
 	def createTable(self, table, columns):
 		columns = ", ".join(columns)
 		query = f"CREATE TABLE IF NOT EXISTS {table} ({columns})"
-		self._connect()
-		self.cursor.execute(query)
-		self.conn.commit()
-		self._close()
+		self._execute(query)
 
-	@lock
+	@write
 	def delete(self, table, condition):
-		condition = joinConditions(condition)
-		query = f"DELETE FROM {table} {condition}"
-		self._connect()
-		self.cursor.execute(query)
-		self.conn.commit()
-		self._close()
-
-	@lock
-	def insert(self, table, data):
+
+		for condition in splitConditions(condition):
+			condition, params = joinConditions(condition)
+			query = f"DELETE FROM {table} {condition}"
+			self._execute(query, params)
+
+	@write
+	def execute(self, statements):
+		# statements: ((query, params), ...) > committed together as one transaction
+		for query, params in statements:
+			self._execute(query, params)
+
+	@read
+	def getVersion(self):
+		return self._fetchOne("PRAGMA user_version")[0]
+
+	@write
+	def insert(self, table, data, replace=False):
 		columns = ", ".join(data.keys())
 		placeholders = ":" + ", :".join(data.keys())
-		query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
-		self._connect()
-		self.cursor.execute(query, data)
-		self.conn.commit()
-		self._close()
-
-	@lock
-	def insertMany(self, table, columns, data):
+		query = f"INSERT {'OR REPLACE ' if replace else ''}INTO {table} ({columns}) VALUES ({placeholders})"
+		self._execute(query, data)
+
+	@write
+	def insertMany(self, table, columns, data, replace=False):
 		placeholders = ", ".join("?" * len(columns))
-		query = f"INSERT INTO {table} {columns} VALUES ({placeholders})"
-		self._connect()
-		self.cursor.executemany(query, data)
-		self.conn.commit()
-		self._close()
+		query = f"INSERT {'OR REPLACE ' if replace else ''}INTO {table} {columns} VALUES ({placeholders})"
+		self._executeMany(query, data)
+
+	@write
+	def migrate(self, migrations):
+		# migrations: ((version, statements), ...) > every pending step is applied in a single transaction
+		version = self._fetchOne("PRAGMA user_version")[0]
+		pending = [(v, statements) for v, statements in migrations if v > version]
+
+		if not pending:
+			return
+
+		self._execute("BEGIN")
+
+		for version, statements in pending:
 
-	@lock
+			for statement in statements:
+				self._execute(statement)
+
+		self._execute(f"PRAGMA user_version = {int(version)}")
+
+	@write
+	def setVersion(self, version):
+		self._execute(f"PRAGMA user_version = {int(version)}")
+
+	@read
+	def query(self, query, params=()):
+		return [dict(row) for row in self._fetchAll(query, params)]
+
+	@read
 	def select(self, table, column, condition=None, caseSensitive=True):
 		query = f"SELECT {column} FROM {table}"
+		params = []
 
 		if condition:
-			query += f" {joinConditions(condition)}"
+			condition, params = joinConditions(condition)
+			query += f" {condition}"
 
 		if not caseSensitive:
 			query += " COLLATE NOCASE"
 
-		self._connect()
-		self.cursor.execute(query)
-		row = self.cursor.fetchone()
-		self._close()
+		row = self._fetchOne(query, params)
 		if row: return row[0]
 
-	@lock
+	@read
 	def selectAll(self, table, condition=None, caseSensitive=True):
-		query = f"SELECT * FROM {table}"
+		rows = []
 
-		if condition:
-			query += f" {joinConditions(condition)}"
+		for condition in splitConditions(condition or {}):
+			query = f"SELECT * FROM {table}"
+			params = []
 
-		if not caseSensitive:
-			query += " COLLATE NOCASE"
+			if condition:
+				condition, params = joinConditions(condition)
+				query += f" {condition}"
+
+			if not caseSensitive:
+				query += " COLLATE NOCASE"
+
+			rows += self._fetchAll(query, params)
 
-		self._connect()
-		self.cursor.execute(query)
-		rows = self.cursor.fetchall()
-		self._close()
 		return [dict(row) for row in rows]
 
-	@lock
+	@write
 	def update(self, table, data, condition=None):
-		setValues = ", ".join([f"{column} = :{column}" for column in data.keys()])
+		setValues = ", ".join([f"{column} = ?" for column in data.keys()])
 		query = f"UPDATE {table} SET {setValues}"
+		params = list(data.values())
 
-		if condition:
-			query += f" {joinConditions(condition)}"
-
-		self._connect()
-		self.cursor.execute(query, data)
-		self.conn.commit()
-		self._close()
+		if not condition:
+			self._execute(query, params)
+			return
 
-	def _close(self):
-		self.conn.close()
+		for condition in splitConditions(condition):
+			condition, conditionParams = joinConditions(condition)
+			self._execute(f"{query} {condition}", params + conditionParams)
 
 	def _connect(self):
-		self.conn = sqlite3.connect(self.database, check_same_thread=False, timeout=15)
-		self.conn.row_factory = sqlite3.Row
-		self.cursor = self.conn.cursor()
+		return self.connectionManager.connection()
+
+	def _buffer(self, query, paramsList):
+		unit = self.connectionManager.unitOfWork()
+
+		if not unit.depth:
+			return False
+
+		if unit.statements and unit.statements[-1][0] == query:
+			unit.statements[-1][1].extend(paramsList)
+		else:
+			unit.statements.append((query, list(paramsList)))
+
+		table = re.match(r"\s*(?:INSERT(?: OR \w+)? INTO|UPDATE|DELETE FROM)\s+(\w+)", query)
+		unit.tables.add(table.group(1) if table else "*")
+		return True
+
+	def _execute(self, query, params=()):
+
+		if not self._buffer(query, (params,)):
+			self._connect().execute(query, params).close()
+
+	def _executeMany(self, query, paramsList):
+
+		if not self._buffer(query, paramsList):
+			self._connect().executemany(query, paramsList)
+
+	def _fetchAll(self, query, params=()):
+		self._flushFor(query)
+		cursor = self._connect().execute(query, params)
+
+		try:
+			return cursor.fetchall()
+		finally:
+			cursor.close()
+
+	def _fetchOne(self, query, params=()):
+		# closing the cursor ends the statement so the connection doesn't pin an old WAL snapshot
+		self._flushFor(query)
+		cursor = self._connect().execute(query, params)
+
+		try:
+			return cursor.fetchone()
+		finally:
+			cursor.close()
+
+	def _flushFor(self, query):
+		tables = self.connectionManager.unitOfWork().tables
+
+		if not tables or query.startswith("PRAGMA"):
+			return
+
+		table = re.match(r"\s*SELECT\b.*?\bFROM\s+(\w+)", query, re.DOTALL)
+
+		if not table or "*" in tables or table.group(1) in tables:
+			self.flush()
@@ -77,14 +77,16 @@ class FileOperations:
 
 		if file:
 
-			if encrypted:
+			with file:
 
-				with self.lock:
-					filePath = generateFilePath(dirPath, filename)
-					self.encryption.decryptStream(file, filePath, modifiedTime=modifiedTime)
+				if encrypted:
 
-			else:
-				filePath = self.createFile(dirPath, filename, file.read(), modifiedTime=modifiedTime)
+					with self.lock:
+						filePath = generateFilePath(dirPath, filename)
+						self.encryption.decryptStream(file, filePath, modifiedTime=modifiedTime)
+
+				else:
+					filePath = self.createFile(dirPath, filename, file.read(), modifiedTime=modifiedTime)
 
 			return filePath
 
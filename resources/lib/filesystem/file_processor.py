@@ -1,13 +1,8 @@
 import os
 import re
-import queue
-import threading
-import traceback
-
-import xbmc
 
 from .fs_constants import ARTWORK
-from ..threadpool.threadpool import ThreadPool
+from ..threadpool.threadpool import PRIORITY_LOW, ThreadPool
 from ..library.library_editor import DatabaseEditor
 from ..title_identifier.title_helpers import getTMDBSettings
 from ..title_identifier.title_identifier import TitleIdentifier
@@ -17,33 +12,42 @@ dbEditor = DatabaseEditor()
 cacheManager = TitleCacheManager()
 
 
-class RemoteFileProcessor(queue.Queue):
+class RemoteFileProcessor:
 
-	def __init__(self, fileOperations, cacheUpdater, threadCount, progressDialog=None):
-		super().__init__()
+	def __init__(self, fileOperations, cacheUpdater, progressDialog=None):
 		self.fileOperations = fileOperations
 		self.cacheUpdater = cacheUpdater
-		self.threadCount = threadCount
 		self.progressDialog = progressDialog
-		self.stop_event = threading.Event()
-		self.monitor = xbmc.Monitor()
-		self._startWorkers()
+		self.pool = ThreadPool()
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, excType, excValue, excTraceback):
-		self.join()
+		self.pool.shutdown()
 		self.cacheUpdater.addDirectories()
 		self.cacheUpdater.addFiles()
-		self._stop()
 
 	def addFile(self, data):
-		self.put(data)
+		self.pool.submit(self._processFile, *data)
 
 		if self.progressDialog:
 			self.progressDialog.incrementFile()
 
+	def _processFile(self, file, folder):
+
+		if file.type == "video":
+			self._processVideo(file, folder)
+		elif file.type == "media_asset":
+			self._processMediaAsset(file, folder)
+		else:
+			self._processSTRM(file, folder)
+
+		self.cacheUpdater.addFile(folder, file)
+
+		if self.progressDialog:
+			self.progressDialog.processFile(file.remoteName)
+
 	def _processMediaAsset(self, file, folder):
 		dirPath = folder.processingPath or folder.localPath
 		filePath = self.fileOperations.downloadFile(dirPath, file.remoteName, file.id, modifiedTime=file.modifiedTime, encrypted=file.encrypted)
@@ -69,49 +73,6 @@ class RemoteFileProcessor(queue.Queue):
 		if file.updateDB and not folder.processingPath:
 			dbEditor.processData(filePath, dirPath, localName)
 
-	def _startWorkers(self):
-		[threading.Thread(target=self._worker).start() for _ in range(self.threadCount)]
-
-	def _stop(self):
-		self.stop_event.set()
-
-	def _stopped(self):
-		return self.stop_event.is_set()
-
-	def _worker(self):
-
-		while not self.monitor.abortRequested():
-
-			if self._stopped():
-				return
-
-			try:
-				file, folder = self.get_nowait()
-
-				if file.type == "video":
-					self._processVideo(file, folder)
-				elif file.type == "media_asset":
-					self._processMediaAsset(file, folder)
-				else:
-					self._processSTRM(file, folder)
-
-				self.cacheUpdater.addFile(folder, file)
-
-				if self.progressDialog:
-					self.progressDialog.processFile(file.remoteName)
-
-				self.task_done()
-
-			except queue.Empty:
-
-				if self.monitor.waitForAbort(0.1):
-					self._stop()
-					return
-
-			except Exception as e:
-				xbmc.log(f"gdrive error: {e}: {''.join(traceback.format_tb(e.__traceback__))}", xbmc.LOGERROR)
-				self.task_done()
-
 
 class LocalFileProcessor:
 
@@ -121,7 +82,7 @@ class LocalFileProcessor:
 		self.syncRootPath = syncRootPath
 		self.progressDialog = progressDialog
 
-	def processFiles(self, folder, folderSettings, threadCount):
+	def processFiles(self, folder, folderSettings):
 		files = folder.files
 		dirPath = folder.localPath
 		videos = files.get("video")
@@ -129,6 +90,8 @@ class LocalFileProcessor:
 		titleIdentifier = TitleIdentifier(getTMDBSettings(folderSettings))
 		folderRenaming = folderSettings["folder_renaming"]
 		fileRenaming = folderSettings["file_renaming"]
+		# the workers only collect their cache updates so they can be written in one transaction
+		updates = []
 
 		if self.progressDialog:
 			strm = files.get("strm")
@@ -138,7 +101,7 @@ class LocalFileProcessor:
 
 		if videos:
 
-			with ThreadPool(threadCount) as pool:
+			with ThreadPool(PRIORITY_LOW) as pool:
 				[
 					pool.submit(
 						self._processVideo,
@@ -147,12 +110,13 @@ class LocalFileProcessor:
 						folderRenaming,
 						fileRenaming,
 						titleIdentifier,
+						updates,
 					) for file in videos
 				]
 
 		if mediaAssets:
 
-			with ThreadPool(threadCount) as pool:
+			with ThreadPool(PRIORITY_LOW) as pool:
 				[
 					pool.submit(
 						self._processMediaAsset,
@@ -161,10 +125,16 @@ class LocalFileProcessor:
 						folderRenaming,
 						fileRenaming,
 						titleIdentifier,
+						updates,
 					) for file in mediaAssets
 				]
 
-	def _processMediaAsset(self, file, dirPath, folderRenaming, fileRenaming, titleIdentifier):
+		with self.cache.transaction():
+
+			for data, fileID in updates:
+				self.cache.updateFile(data, fileID)
+
+	def _processMediaAsset(self, file, dirPath, folderRenaming, fileRenaming, titleIdentifier, updates):
 		filename = file.localName
 		remoteName = file.remoteName
 		mediaType = file.media
@@ -224,9 +194,9 @@ class LocalFileProcessor:
 			"original_name": originalName,
 			"original_folder": originalFolder,
 		}
-		self.cache.updateFile(data, file.id)
+		updates.append((data, file.id))
 
-	def _processVideo(self, file, dirPath, folderRenaming, fileRenaming, titleIdentifier):
+	def _processVideo(self, file, dirPath, folderRenaming, fileRenaming, titleIdentifier, updates):
 		filename = f"{file.basename}.strm"
 		mediaType = file.media
 		originalName = originalFolder = True
@@ -272,4 +242,4 @@ class LocalFileProcessor:
 			"original_name": originalName,
 			"original_folder": originalFolder,
 		}
-		self.cache.updateFile(data, file.id)
+		updates.append((data, file.id))
@@ -1,15 +1,23 @@
 import os
+import asyncio
+import threading
+
+import xbmc
 
 from .folder import Folder
 from .file_maker import makeFile
 from .fs_constants import MEDIA_ASSETS
 from .fs_helpers import removeProhibitedFSchars
-from ..threadpool.threadpool import ThreadPool
+from ..threadpool.threadpool import EXECUTOR, PRIORITY_HIGH, ThreadPool
+from ..google_api.query_planner import getParentsQuery
+
+MAX_IDS = 299
+MAX_QUERIES = 8
 
 
 class FileTree:
 
-	def __init__(self, fileProcessor, cloudService, cache, cacheUpdater, driveID, syncRootPath, drivePath, folderRenaming, fileRenaming, threadCount, encryptor, prefix, suffix, excludedTypes, syncedIDs):
+	def __init__(self, fileProcessor, cloudService, cache, cacheUpdater, driveID, syncRootPath, drivePath, folderRenaming, fileRenaming, encryptor, prefix, suffix, excludedTypes, syncedIDs):
 		self.fileProcessor = fileProcessor
 		self.cloudService = cloudService
 		self.cache = cache
@@ -18,7 +26,6 @@ class FileTree:
 		self.syncRootPath = syncRootPath
 		self.drivePath = drivePath
 		self.folderRenaming = folderRenaming
-		self.threadCount = threadCount
 		self.encryptor = encryptor
 		self.prefix = prefix
 		self.suffix = suffix
@@ -27,6 +34,9 @@ class FileTree:
 		self.rename = folderRenaming or fileRenaming
 		self.folderIDs = []
 		self.fileTree = {}
+		self.paths = set()
+		self.queries = 0
+		self.lock = threading.RLock()
 
 	def __iter__(self):
 		return iter(self.fileTree.values())
@@ -39,39 +49,32 @@ class FileTree:
 		self._getContents()
 
 	def _getContents(self):
-		maxIDs = 299
-		queries = []
 
-		while self.folderIDs:
-			ids = self.folderIDs[:maxIDs]
-			queries.append(
-				(
-					"not trashed and (" + " or ".join(f"'{id}' in parents" for id in ids) + ")",
-					ids,
-				)
-			)
-			self.folderIDs = self.folderIDs[maxIDs:]
-
-		def getFolders(query, parentFolderIDs):
-			items = self.cloudService.listDirectory(customQuery=query)
-			self._filterContents(items)
+		if asyncio.iscoroutinefunction(self.cloudService.listDirectoryPage):
+			# the async client crawls on its own event loop, bounded by its request limit instead of MAX_QUERIES
+			self.cloudService.run(self._getPagesAsync(self._takeQueries()))
+			return
 
-		with ThreadPool(self.threadCount) as pool:
-			pool.map(getFolders, queries)
+		with ThreadPool(PRIORITY_HIGH) as pool:
 
-		if self.folderIDs:
-			self._getContents()
+			with self.lock:
+				self._queryFolders(pool)
+
+		# a failed page leaves its folders' contents out > the tree mustn't be taken as complete
+		for future in pool.futures:
+
+			if future.exception():
+				raise future.exception()
 
 	def _filterContents(self, items):
-		paths = set()
 
 		for item in items:
 			id = item["id"]
 			parentFolderID = item["parents"][0]
 			isFolder = item["mimeType"] == "application/vnd.google-apps.folder"
 
-			if self.syncedIDs:
-				self.syncedIDs.append(id)
+			if self.syncedIDs is not None:
+				self.syncedIDs.add(id, "crawled")
 
 				if isFolder and self.cache.getDirectory({"folder_id": id}):
 					continue
@@ -81,17 +84,17 @@ class FileTree:
 				path = path_ = os.path.join(self.fileTree[parentFolderID].remotePath, folderName)
 				copy = 1
 
-				if self.syncedIDs:
-					path = self.cache.getUniqueDirectoryPath(self.driveID, path, paths=paths)
+				if self.syncedIDs is not None:
+					path = self.cache.getUniqueDirectoryPath(self.driveID, path, paths=self.paths)
 
-				while path.lower() in paths:
+				while path.lower() in self.paths:
 					path = f"{path_} ({copy})"
 					copy += 1
 
 				folder = Folder(id, parentFolderID, self.rootFolderID, self.driveID, folderName, path, os.path.join(self.drivePath, path), self.syncRootPath, self.folderRenaming, item["modifiedTime"])
 				self.fileTree[id] = folder
 				self.cacheUpdater.addDirectory(folder)
-				paths.add(path.lower())
+				self.paths.add(path.lower())
 				self.folderIDs.append(id)
 			else:
 				file = makeFile(item, self.excludedTypes, self.prefix, self.suffix, self.encryptor)
@@ -108,3 +111,71 @@ class FileTree:
 						files["media_asset"].append(file)
 					else:
 						files[file.type].append(file)
+
+	def _getPage(self, pool, query, pageToken=None):
+
+		try:
+			items, pageToken = self.cloudService.listDirectoryPage(query, pageToken)
+
+			# the next page is requested before this one is processed
+			if pageToken:
+
+				with self.lock:
+					self.queries += 1
+
+				pool.submit(self._getPage, pool, query, pageToken)
+
+			with self.lock:
+				self._filterContents(items)
+
+		finally:
+
+			with self.lock:
+				self.queries -= 1
+				self._queryFolders(pool)
+
+	def _filterPage(self, items):
+
+		with self.lock:
+			self._filterContents(items)
+			return self._takeQueries()
+
+	async def _getPageAsync(self, query, pageToken=None):
+
+		try:
+			items, pageToken = await self.cloudService.listDirectoryPage(query, pageToken)
+			# the cache lookups block > they run on the shared executor so the loop keeps the other requests going
+			queries = await asyncio.wrap_future(EXECUTOR.submit(self._filterPage, items, priority=PRIORITY_HIGH))
+		except Exception as e:
+			xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
+			raise
+
+		pages = [self._getPageAsync(query, pageToken)] if pageToken else []
+		await self._getPagesAsync(queries, pages)
+
+	async def _getPagesAsync(self, queries, pages=()):
+		# sibling pages still finish when one fails > the failure is raised afterwards so the tree isn't taken as complete
+		results = await asyncio.gather(*pages, *(self._getPageAsync(query) for query in queries), return_exceptions=True)
+
+		for result in results:
+
+			if isinstance(result, BaseException):
+				raise result
+
+	def _queryFolders(self, pool):
+		# child folders are queried as soon as they're found, in batches of whatever has piled up while
+		# MAX_QUERIES requests are in flight
+
+		for query in self._takeQueries(MAX_QUERIES - self.queries):
+			self.queries += 1
+			pool.submit(self._getPage, pool, query)
+
+	def _takeQueries(self, limit=None):
+		queries = []
+
+		while self.folderIDs and (limit is None or len(queries) < limit):
+			ids = self.folderIDs[:MAX_IDS]
+			self.folderIDs = self.folderIDs[MAX_IDS:]
+			queries.append(getParentsQuery(ids, self.excludedTypes))
+
+		return queries
@@ -0,0 +1,172 @@
+import os
+import asyncio
+import threading
+
+from .google_drive import API, GoogleDrive, ListingError
+from ..network import async_requester
+from ..network.rate_limiter import MAX_CONCURRENT
+from ..threadpool.threadpool import EXECUTOR
+from ..network.network_helpers import addQueryString, mergePaths
+from ..filesystem.fs_helpers import removeProhibitedFSchars
+
+
+class AsyncGoogleDrive:
+	# Coroutine version of GoogleDrive's listing, change and download calls. Every request runs on one event
+	# loop owned by the client, with at most maxConcurrent in flight. The account, tokens and parent memo
+	# are those of the wrapped GoogleDrive. run() lets threads wait for a coroutine on that loop.
+
+	def __init__(self, cloudService, maxConcurrent=MAX_CONCURRENT):
+		self.cloudService = cloudService
+		self.maxConcurrent = maxConcurrent
+		self.semaphore = None
+		self.loop = None
+		self.lock = threading.Lock()
+
+	async def downloadFile(self, fileID):
+		params = {"alt": "media"}
+		url = addQueryString(mergePaths(API["files"], fileID), params)
+		response = await self._request(url, raw=True)
+
+		if response:
+			return response.read()
+
+	async def getChangePages(self, pageToken):
+
+		if not pageToken:
+			pageToken = await self.getPageToken()
+
+		params = GoogleDrive._getChangesParams(pageToken)
+
+		while pageToken:
+			url = addQueryString(API["changes"], params)
+			response = await self._request(url)
+
+			if not response:
+				return
+
+			pageToken = response.get("nextPageToken")
+			yield response.get("changes", []), pageToken, response.get("newStartPageToken")
+			params["pageToken"] = pageToken
+
+	async def getDirectory(self, cache, folderID):
+		cachedFolder = cache.getFolder({"folder_id": folderID})
+
+		if cachedFolder:
+			return cachedFolder["local_path"], folderID
+
+		dirPath = ""
+
+		while True:
+			parent = self.cloudService.parentCache.get(folderID) or await self._getParent(folderID)
+
+			if not parent or not parent[1]:
+				return None, None
+
+			dirName, folderID = parent
+			dirPath = os.path.join(dirName, dirPath)
+			cachedDirectory = cache.getDirectory({"folder_id": folderID})
+
+			if cachedDirectory:
+				rootFolderID = cachedDirectory["root_folder_id"]
+				dirPath = os.path.join(cachedDirectory["local_path"], dirPath).rstrip(os.sep)
+				return dirPath, rootFolderID
+
+			cachedFolder = cache.getFolder({"folder_id": folderID})
+
+			if cachedFolder:
+				rootFolderID = folderID
+				dirPath = os.path.join(cachedFolder["local_path"], dirPath).rstrip(os.sep)
+				return dirPath, rootFolderID
+
+	async def getPageToken(self):
+		params = {"supportsAllDrives": "true"}
+		url = addQueryString(mergePaths(API["changes"], "startPageToken"), params)
+		response = await self._request(url)
+		return response.get("startPageToken")
+
+	def iterate(self, asyncGenerator):
+		# steps through an async generator from a thread > the pages are fetched on the loop one at a time
+
+		while True:
+
+			try:
+				yield self.run(asyncGenerator.__anext__())
+			except StopAsyncIteration:
+				return
+
+	async def listDirectory(self, folderID="root", sharedWithMe=False, foldersOnly=False, starred=False, search=False, customQuery=False):
+		return [item async for page in self.listDirectoryPages(folderID, sharedWithMe, foldersOnly, starred, search, customQuery) for item in page]
+
+	async def listDirectoryPage(self, query, pageToken=None):
+		params = GoogleDrive._getListParams(customQuery=query)
+
+		if pageToken:
+			params["pageToken"] = pageToken
+
+		url = addQueryString(API["files"], params)
+		response = await self._request(url)
+
+		if not response:
+			raise ListingError(query)
+
+		return response.get("files", []), response.get("nextPageToken")
+
+	async def listDirectoryPages(self, folderID="root", sharedWithMe=False, foldersOnly=False, starred=False, search=False, customQuery=False):
+		params = GoogleDrive._getListParams(folderID, sharedWithMe, foldersOnly, starred, search, customQuery)
+		pageToken = True
+
+		while pageToken:
+			url = addQueryString(API["files"], params)
+			response = await self._request(url)
+
+			if not response:
+				raise ListingError(params.get("q"))
+
+			pageToken = response.get("nextPageToken")
+			yield response.get("files", [])
+			params["pageToken"] = pageToken
+
+	def run(self, coroutine):
+		# waited on through the executor > a worker blocked here hands its slot over, so the tasks the coroutine
+		# submits to the executor still get to run
+		future = asyncio.run_coroutine_threadsafe(coroutine, self._getLoop())
+		future.add_done_callback(lambda future: EXECUTOR.notify())
+		EXECUTOR.wait([future])
+		return future.result()
+
+	def _getLoop(self):
+
+		with self.lock:
+
+			if not self.loop:
+				self.loop = asyncio.new_event_loop()
+				threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+			return self.loop
+
+	async def _getParent(self, folderID):
+		params = {
+			"fields": "parents,name",
+			"supportsAllDrives": "true",
+			"includeItemsFromAllDrives": "true",
+		}
+		url = addQueryString(mergePaths(API["files"], folderID), params)
+		response = await self._request(url)
+
+		try:
+			dirName = response["name"]
+		except (KeyError, TypeError):
+			return
+
+		parents = response.get("parents")
+		parent = removeProhibitedFSchars(dirName), parents[0] if parents else None
+		self.cloudService.parentCache[folderID] = parent
+		return parent
+
+	async def _request(self, url, raw=False):
+
+		if not self.semaphore:
+			self.semaphore = asyncio.Semaphore(self.maxConcurrent)
+
+		async with self.semaphore:
+			return await async_requester.request(url, headers=self.cloudService.getHeaders(), raw=raw, limiter=self.cloudService.getRateLimiter())
@@ -1,10 +1,14 @@
 import os
 import re
+import json
+import uuid
 import datetime
 import urllib.parse
 
 from ..network import http_requester
-from ..network.network_helpers import addQueryString, mergePaths
+from ..network.rate_limiter import RateLimiter
+from .query_planner import getChangeFields, getListFields
+from ..network.network_helpers import addQueryString, mergePaths, parseMultipartResponse
 from ..encryption.jwt import JsonWebToken
 from ..filesystem.fs_helpers import removeProhibitedFSchars
 
@@ -13,6 +17,9 @@ GDRIVE_URL = "https://www.googleapis.com/drive/v3"
 GOOGLE_AUTH_URL = "https://accounts.google.com/o/oauth2/v2/auth"
 GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
 SCOPE_URL = "https://www.googleapis.com/auth/drive.readonly"
+BATCH_URL = "https://www.googleapis.com/batch/drive/v3"
+# the Drive batch endpoint accepts at most 100 calls per request
+BATCH_LIMIT = 100
 
 API = {
 	"changes": f"{GDRIVE_URL}/changes",
@@ -21,15 +28,25 @@ API = {
 }
 
 
+class ListingError(Exception):
+	# a listing request that still failed after its retries > the folder's listing would be incomplete
+	pass
+
+
 class GoogleDrive:
 
 	def __init__(self):
 		self.account = None
+		# folderID > (folder name, parent folderID) for folders resolved during the current sync pass
+		self.parentCache = {}
+
+	def clearParentCache(self):
+		self.parentCache = {}
 
 	def downloadFile(self, fileID):
 		params = {"alt": "media"}
 		url = addQueryString(mergePaths(API["files"], fileID), params)
-		return http_requester.request(url, headers=self.getHeaders(), raw=True)
+		return http_requester.request(url, headers=self.getHeaders(), raw=True, limiter=self.getRateLimiter())
 
 	def getAuthURL(self, clientID, port):
 		params = {
@@ -42,62 +59,55 @@ class GoogleDrive:
 		}
 		return addQueryString(GOOGLE_AUTH_URL, params)
 
-	def getChanges(self, pageToken):
+	def getChangePages(self, pageToken):
+		# yields (changes, nextPageToken, newStartPageToken) one page at a time > either token resumes the listing right after the page
 
 		if not pageToken:
 			pageToken = self.getPageToken()
 
-		params = {
-			"pageToken": pageToken,
-			"fields": "nextPageToken,newStartPageToken,changes(file(id,name,parents,trashed,mimeType,fileExtension,videoMediaMetadata,modifiedTime))",
-			"supportsAllDrives": "true",
-			"includeItemsFromAllDrives": "true",
-			"pageSize": "1000",
-		}
-		changes = []
-		pageToken = True
+		params = self._getChangesParams(pageToken)
 
 		while pageToken:
 			url = addQueryString(API["changes"], params)
-			response = http_requester.request(url, headers=self.getHeaders())
+			response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
+
+			if not response:
+				# the pass stops at the last checkpoint and the remaining pages are fetched next time
+				return
+
 			pageToken = response.get("nextPageToken")
-			changes += response.get("changes")
+			yield response.get("changes", []), pageToken, response.get("newStartPageToken")
 			params["pageToken"] = pageToken
 
-		return changes, response.get("newStartPageToken")
-
 	def getDirectory(self, cache, folderID):
-		dirPath = ""
-		cachedDirectory = None
 		cachedFolder = cache.getFolder({"folder_id": folderID})
-		params = {
-			"fields": "parents,name",
-			"supportsAllDrives": "true",
-			"includeItemsFromAllDrives": "true",
-		}
 
-		while not cachedDirectory and not cachedFolder:
-			url = addQueryString(mergePaths(API["files"], folderID), params)
-			response = http_requester.request(url, headers=self.getHeaders())
+		if cachedFolder:
+			return cachedFolder["local_path"], folderID
+
+		dirPath = ""
+
+		while True:
+			parent = self.parentCache.get(folderID) or self._getParent(folderID)
 
-			try:
-				dirName, folderID = response["name"], response["parents"][0]
-			except KeyError:
+			if not parent or not parent[1]:
 				return None, None
 
-			dirName = removeProhibitedFSchars(dirName)
+			dirName, folderID = parent
 			dirPath = os.path.join(dirName, dirPath)
 			cachedDirectory = cache.getDirectory({"folder_id": folderID})
+
+			if cachedDirectory:
+				rootFolderID = cachedDirectory["root_folder_id"]
+				dirPath = os.path.join(cachedDirectory["local_path"], dirPath).rstrip(os.sep)
+				return dirPath, rootFolderID
+
 			cachedFolder = cache.getFolder({"folder_id": folderID})
 
-		if cachedDirectory:
-			rootFolderID = cachedDirectory["root_folder_id"]
-			dirPath = os.path.join(cachedDirectory["local_path"], dirPath).rstrip(os.sep)
-			return dirPath, rootFolderID
-		elif cachedFolder:
-			rootFolderID = folderID
-			dirPath = os.path.join(cachedFolder["local_path"], dirPath).rstrip(os.sep)
-			return dirPath, rootFolderID
+			if cachedFolder:
+				rootFolderID = folderID
+				dirPath = os.path.join(cachedFolder["local_path"], dirPath).rstrip(os.sep)
+				return dirPath, rootFolderID
 
 	@staticmethod
 	def getDownloadURL(fileID):
@@ -109,7 +119,7 @@ class GoogleDrive:
 
 	def getDriveID(self):
 		url = mergePaths(API["files"], "root")
-		response = http_requester.request(url, headers=self.getHeaders())
+		response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
 
 		if response:
 			return response.get("id")
@@ -121,9 +131,13 @@ class GoogleDrive:
 
 		while pageToken:
 			url = addQueryString(API["drives"], params)
-			response = http_requester.request(url, headers=self.getHeaders())
+			response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
+
+			if not response:
+				break
+
 			pageToken = response.get("nextPageToken")
-			drives += response.get("drives")
+			drives += response.get("drives", [])
 			params["pageToken"] = pageToken
 
 		return drives
@@ -147,29 +161,44 @@ class GoogleDrive:
 	def getHeadersEncoded(self):
 		return urllib.parse.urlencode(self.getHeaders())
 
+	def getModifiedTime(self, fileID):
+		params = {"fields": "modifiedTime", "supportsAllDrives": "true"}
+		url = addQueryString(mergePaths(API["files"], fileID), params)
+		response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
+		return response.get("modifiedTime") if isinstance(response, dict) else None
+
 	def getPageToken(self):
 		params = {"supportsAllDrives": "true"}
 		url = addQueryString(mergePaths(API["changes"], "startPageToken"), params)
-		response = http_requester.request(url, headers=self.getHeaders())
+		response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
 		return response.get("startPageToken")
 
 	def getParentDirectoryID(self, fileID):
+		parent = self.parentCache.get(fileID)
+
+		if parent:
+			return parent[1]
+
 		params = {
 			"fields": "parents,name",
 			"supportsAllDrives": "true",
 			"includeItemsFromAllDrives": "true",
 		}
 		url = addQueryString(mergePaths(API["files"], fileID), params)
-		response = http_requester.request(url, headers=self.getHeaders())
+		response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
 		id = response.get("parents")
 
 		if id:
 			return id[0]
 
+	def getRateLimiter(self):
+		# quota is counted per user, so every client of an account shares its limiter
+		return RateLimiter.get(self.account.email or self.account.clientID or self.account.name)
+
 	def getStreams(self, fileID, resolutionPriority=None):
 		url = f"https://drive.google.com/get_video_info?docid={fileID}"
 		self.account.driveStream = None
-		responseData, cookie = http_requester.request(url, headers=self.getHeaders(), cookie=True)
+		responseData, cookie = http_requester.request(url, headers=self.getHeaders(), cookie=True, limiter=self.getRateLimiter())
 		self.account.driveStream = re.search("DRIVE_STREAM=(.*?);", cookie).group(1)
 
 		for _ in range(5):
@@ -226,40 +255,37 @@ class GoogleDrive:
 		return http_requester.request(GOOGLE_TOKEN_URL, data, method="POST")
 
 	def listDirectory(self, folderID="root", sharedWithMe=False, foldersOnly=False, starred=False, search=False, customQuery=False):
-		params = {
-			"supportsAllDrives": "true",
-			"includeItemsFromAllDrives": "true",
-			"pageSize": "1000",
-		}
+		return [item for page in self.listDirectoryPages(folderID, sharedWithMe, foldersOnly, starred, search, customQuery) for item in page]
 
-		if customQuery:
-			params["q"] = customQuery
-			params["fields"] = "nextPageToken,files(id,parents,name,mimeType,videoMediaMetadata,fileExtension,modifiedTime)"
-		elif foldersOnly:
+	def listDirectoryPage(self, query, pageToken=None):
+		params = self._getListParams(customQuery=query)
 
-			if sharedWithMe:
-				params["q"] = "mimeType='application/vnd.google-apps.folder' and sharedWithMe=true and not trashed"
-			elif starred:
-				params["q"] = "mimeType='application/vnd.google-apps.folder' and starred and not trashed"
-			elif search:
-				params["q"] = f"mimeType='application/vnd.google-apps.folder' and name contains '{search}' and not trashed"
-			else:
-				params["q"] = f"mimeType='application/vnd.google-apps.folder' and '{folderID}' in parents and not trashed"
+		if pageToken:
+			params["pageToken"] = pageToken
+
+		url = addQueryString(API["files"], params)
+		response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
+
+		if not response:
+			raise ListingError(query)
 
-			params["fields"] = "nextPageToken,files(id,name,modifiedTime)"
+		return response.get("files", []), response.get("nextPageToken")
 
-		items = []
+	def listDirectoryPages(self, folderID="root", sharedWithMe=False, foldersOnly=False, starred=False, search=False, customQuery=False):
+		params = self._getListParams(folderID, sharedWithMe, foldersOnly, starred, search, customQuery)
 		pageToken = True
 
 		while pageToken:
 			url = addQueryString(API["files"], params)
-			response = http_requester.request(url, headers=self.getHeaders())
+			response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
+
+			if not response:
+				raise ListingError(params.get("q"))
+
 			pageToken = response.get("nextPageToken")
-			items += response.get("files")
+			yield response.get("files", [])
 			params["pageToken"] = pageToken
 
-		return items
-
 	def refreshToken(self):
 		key = self.account.key
 
@@ -287,5 +313,134 @@ class GoogleDrive:
 		self.account.expiry = expiry
 		return True
 
+	def resolveParents(self, cache, folderIDs, folders=()):
+		# walks the ancestry of many folders at once, one batch request per tree level, until every branch
+		# reaches a synced directory > later getDirectory calls in the same pass are answered from memory
+		for folder in folders:
+			parents = folder.get("parents")
+			self.parentCache[folder["id"]] = removeProhibitedFSchars(folder["name"]), parents[0] if parents else None
+
+		pending = set(folderIDs) | {folder["id"] for folder in folders}
+		visited = set()
+
+		while pending:
+			visited |= pending
+			self._batchGetParents([id for id in pending if id not in self.parentCache])
+			parentIDs = set()
+
+			for folderID in pending:
+				parent = self.parentCache.get(folderID)
+
+				if not parent or not parent[1]:
+					continue
+
+				parentID = parent[1]
+
+				if parentID in visited or cache.getDirectory({"folder_id": parentID}) or cache.getFolder({"folder_id": parentID}):
+					continue
+
+				parentIDs.add(parentID)
+
+			pending = parentIDs
+
 	def setAccount(self, account):
 		self.account = account
+
+	def _batchGetParents(self, folderIDs):
+		params = {
+			"fields": "parents,name",
+			"supportsAllDrives": "true",
+			"includeItemsFromAllDrives": "true",
+		}
+
+		for idx in range(0, len(folderIDs), BATCH_LIMIT):
+			ids = folderIDs[idx:idx + BATCH_LIMIT]
+
+			if len(ids) == 1:
+				self._getParent(ids[0])
+				continue
+
+			boundary = f"batch_{uuid.uuid4().hex}"
+			body = "".join(
+				f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <{num}>\r\n\r\n"
+				f"GET {addQueryString(f'/drive/v{API_VERSION}/files/{id}', params)}\r\n\r\n"
+				for num, id in enumerate(ids)
+			)
+			body += f"--{boundary}--\r\n"
+			headers = self.getHeaders(additionalHeader="Content-Type", additionalValue=f"multipart/mixed; boundary={boundary}")
+			response = http_requester.request(BATCH_URL, body.encode("utf-8"), headers=headers, raw=True, limiter=self.getRateLimiter())
+
+			if not response:
+				continue
+
+			with response:
+				responses = parseMultipartResponse(response.headers.get("Content-Type", ""), response.read())
+
+			for num, status, data in responses:
+
+				if status != 200:
+					continue
+
+				try:
+					data = json.loads(data)
+					folderID = ids[int(num)]
+				except (ValueError, TypeError, IndexError):
+					continue
+
+				parents = data.get("parents")
+				self.parentCache[folderID] = removeProhibitedFSchars(data["name"]), parents[0] if parents else None
+
+	@staticmethod
+	def _getChangesParams(pageToken):
+		return {
+			"pageToken": pageToken,
+			"fields": getChangeFields(),
+			"supportsAllDrives": "true",
+			"includeItemsFromAllDrives": "true",
+			"pageSize": "1000",
+		}
+
+	def _getParent(self, folderID):
+		params = {
+			"fields": "parents,name",
+			"supportsAllDrives": "true",
+			"includeItemsFromAllDrives": "true",
+		}
+		url = addQueryString(mergePaths(API["files"], folderID), params)
+		response = http_requester.request(url, headers=self.getHeaders(), limiter=self.getRateLimiter())
+
+		try:
+			dirName = response["name"]
+		except (KeyError, TypeError):
+			return
+
+		parents = response.get("parents")
+		parent = removeProhibitedFSchars(dirName), parents[0] if parents else None
+		self.parentCache[folderID] = parent
+		return parent
+
+	@staticmethod
+	def _getListParams(folderID="root", sharedWithMe=False, foldersOnly=False, starred=False, search=False, customQuery=False):
+		params = {
+			"supportsAllDrives": "true",
+			"includeItemsFromAllDrives": "true",
+			"pageSize": "1000",
+		}
+
+		if customQuery:
+			params["q"] = customQuery
+			params["fields"] = getListFields(foldersOnly)
+		elif foldersOnly:
+
+			if sharedWithMe:
+				params["q"] = "mimeType='application/vnd.google-apps.folder' and sharedWithMe=true and not trashed"
+			elif starred:
+				params["q"] = "mimeType='application/vnd.google-apps.folder' and starred and not trashed"
+			elif search:
+				params["q"] = f"mimeType='application/vnd.google-apps.folder' and name contains '{search}' and not trashed"
+			else:
+				params["q"] = f"mimeType='application/vnd.google-apps.folder' and '{folderID}' in parents and not trashed"
+
+			params["fields"] = getListFields(foldersOnly=True)
+
+		return params
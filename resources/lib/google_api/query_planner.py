@@ -0,0 +1,46 @@
+from ..filesystem.fs_constants import ARTWORK
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# only the parts of the metadata that makeFile reads
+FILE_FIELDS = "id,parents,name,mimeType,fileExtension,modifiedTime,videoMediaMetadata(durationMillis,width,height)"
+FOLDER_FIELDS = "id,name,modifiedTime"
+CHANGE_FIELDS = "id,name,parents,trashed,mimeType,fileExtension,modifiedTime,videoMediaMetadata(durationMillis,width,height)"
+
+# mime types that only ever belong to a file type > filtering on them can't drop anything else
+EXCLUDED_MIME_TYPES = {
+	"nfo": ("text/x-nfo",),
+	"subtitles": ("application/x-subrip", "text/vtt", "text/x-ssa", "application/ttml+xml"),
+}
+
+
+def getChangeFields():
+	return f"nextPageToken,newStartPageToken,changes(time,file({CHANGE_FIELDS}))"
+
+def getExclusionFilters(excludedTypes):
+	# google docs have no file extension so makeFile discards them anyway
+	filters = [f"(mimeType = '{FOLDER_MIME_TYPE}' or not mimeType contains 'application/vnd.google-apps.')"]
+
+	# artwork is the only synced type that's an image
+	if all(type in excludedTypes for type in ARTWORK):
+		filters.append("not mimeType contains 'image/'")
+
+	for type, mimeTypes in EXCLUDED_MIME_TYPES.items():
+
+		if type in excludedTypes:
+			filters += [f"mimeType != '{mimeType}'" for mimeType in mimeTypes]
+
+	return filters
+
+def getListFields(foldersOnly=False):
+	return f"nextPageToken,files({FOLDER_FIELDS if foldersOnly else FILE_FIELDS})"
+
+def getParentsQuery(folderIDs, excludedTypes=None, foldersOnly=False):
+	# the server drops what the folder settings exclude > makeFile still filters whatever a mime type can't express
+	clauses = ["not trashed", "(" + " or ".join(f"'{id}' in parents" for id in folderIDs) + ")"]
+
+	if foldersOnly:
+		clauses.insert(0, f"mimeType='{FOLDER_MIME_TYPE}'")
+	elif excludedTypes is not None:
+		clauses += getExclusionFilters(excludedTypes)
+
+	return " and ".join(clauses)
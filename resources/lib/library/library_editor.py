@@ -3,6 +3,7 @@ import os
 import xbmcvfs
 
 from constants import SETTINGS
+from ..database.db_helpers import Subquery
 from ..database.db_manager import DatabaseManager
 from ..filesystem.file_operations import FileOperations
 
@@ -69,7 +70,7 @@ class DatabaseEditor(DatabaseManager):
 		return data
 
 	def _getFileID(self, dirPath, filename):
-		return self.select("files", "idFile", {"idPath": f'(SELECT idPath FROM path WHERE strPath="{dirPath + os.sep}")', "strFilename": filename})
+		return self.select("files", "idFile", {"idPath": Subquery("SELECT idPath FROM path WHERE strPath = ?", (dirPath + os.sep,)), "strFilename": filename})
 
 	def _getVideoDB(self):
 		dbDirectory = xbmcvfs.translatePath("special://database")
@@ -0,0 +1,197 @@
+import io
+import ssl
+import time
+import asyncio
+import http.client
+import urllib.parse
+from urllib.error import HTTPError, URLError
+
+from .connection_pool import IDLE_TIMEOUT, MAX_REDIRECTS, REDIRECT_CODES
+
+STALE_CONNECTION_ERRORS = (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError)
+
+
+class AsyncResponse:
+
+	def __init__(self, url, status, reason, headers, body):
+		self.url = url
+		self.status = status
+		self.reason = reason
+		self.headers = headers
+		self.body = body
+
+	def geturl(self):
+		return self.url
+
+	def info(self):
+		return self.headers
+
+	def read(self):
+		return self.body
+
+
+class AsyncConnectionPool:
+	# keep-alive HTTP/1.1 connections over asyncio streams > bodies are read in full, so a connection goes back
+	# to the pool as soon as its response is returned. a pool belongs to the event loop it's used on
+
+	def __init__(self, maxSize=100, idleTimeout=IDLE_TIMEOUT):
+		self.maxSize = maxSize
+		self.idleTimeout = idleTimeout
+		self.connections = {}
+		self.sslContext = ssl.create_default_context()
+
+	def clear(self):
+		connections = [conn for idle in self.connections.values() for conn, _ in idle]
+		self.connections = {}
+
+		for _, writer in connections:
+			writer.close()
+
+	async def urlopen(self, url, data=None, headers=None, method=None):
+		headers = dict(headers or {})
+
+		if not method:
+			method = "GET" if data is None else "POST"
+
+		if data is not None:
+			headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+		for _ in range(MAX_REDIRECTS + 1):
+			response = await self._send(url, method, data, headers)
+			status = response.status
+
+			if status in REDIRECT_CODES and response.headers.get("Location"):
+				url = urllib.parse.urljoin(url, response.headers["Location"])
+
+				if status == 303 or (status in (301, 302) and method == "POST"):
+					method, data = "GET", None
+					headers.pop("Content-Type", None)
+
+				continue
+
+			if status >= 400:
+				raise HTTPError(url, status, response.reason, response.headers, io.BytesIO(response.body))
+
+			return response
+
+		raise URLError(f"too many redirects: {url}")
+
+	async def _acquire(self, key):
+		now = time.time()
+		idle = self.connections.get(key, [])
+
+		while idle:
+			conn, lastUsed = idle.pop()
+
+			if now - lastUsed < self.idleTimeout and not conn[0].at_eof():
+				return conn, True
+
+			conn[1].close()
+
+		return await self._connect(key), False
+
+	async def _connect(self, key):
+		scheme, host, port = key
+
+		try:
+			return await asyncio.open_connection(host, port, ssl=self.sslContext if scheme == "https" else None)
+		except OSError as e:
+			raise URLError(e)
+
+	@staticmethod
+	def _encodeRequest(method, path, host, data, headers):
+		headers = {"Host": host, "Accept-Encoding": "identity", **headers}
+
+		if data is not None:
+			headers["Content-Length"] = str(len(data))
+
+		request = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{name}: {value}\r\n" for name, value in headers.items()) + "\r\n"
+		return request.encode("latin-1") + (data or b"")
+
+	async def _readChunked(self, reader):
+		body = bytearray()
+
+		while True:
+			size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+
+			if not size:
+				break
+
+			body += await reader.readexactly(size)
+			await reader.readline()
+
+		# skip the trailers
+		while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+			pass
+
+		return bytes(body)
+
+	async def _readResponse(self, reader, method, url):
+		head = await reader.readuntil(b"\r\n\r\n")
+		statusLine, _, headerBlock = head.partition(b"\r\n")
+		statusLine = statusLine.decode("latin-1").split(" ", 2)
+		status = int(statusLine[1])
+		reason = statusLine[2] if len(statusLine) > 2 else ""
+		headers = http.client.parse_headers(io.BytesIO(headerBlock))
+		reusable = headers.get("Connection", "").lower() != "close"
+
+		if method == "HEAD" or status in (204, 304) or status < 200:
+			body = b""
+		elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+			body = await self._readChunked(reader)
+		elif headers.get("Content-Length"):
+			body = await reader.readexactly(int(headers["Content-Length"]))
+		else:
+			# the body ends with the connection
+			body = await reader.read()
+			reusable = False
+
+		return AsyncResponse(url, status, reason, headers, body), reusable
+
+	def _release(self, key, conn):
+		idle = self.connections.setdefault(key, [])
+
+		if len(idle) < self.maxSize:
+			idle.append((conn, time.time()))
+		else:
+			conn[1].close()
+
+	async def _send(self, url, method, data, headers):
+		parsedURL = urllib.parse.urlsplit(url)
+		port = parsedURL.port or (443 if parsedURL.scheme == "https" else 80)
+		key = (parsedURL.scheme, parsedURL.hostname, port)
+		path = parsedURL.path or "/"
+
+		if parsedURL.query:
+			path += f"?{parsedURL.query}"
+
+		request = self._encodeRequest(method, path, parsedURL.netloc, data, headers)
+		conn, reused = await self._acquire(key)
+
+		while True:
+			reader, writer = conn
+
+			try:
+				writer.write(request)
+				await writer.drain()
+				response, reusable = await self._readResponse(reader, method, url)
+			except STALE_CONNECTION_ERRORS as e:
+				writer.close()
+
+				if not reused:
+					raise URLError(e)
+
+				# the server dropped an idle keep-alive socket > retry once on a fresh connection
+				conn, reused = await self._connect(key), False
+				continue
+
+			except (OSError, ValueError, asyncio.LimitOverrunError) as e:
+				writer.close()
+				raise URLError(e)
+
+			if reusable:
+				self._release(key, conn)
+			else:
+				writer.close()
+
+			return response
@@ -0,0 +1,72 @@
+import json
+import asyncio
+import weakref
+from urllib.error import URLError
+
+import xbmc
+
+from .http_requester import HEADERS, HEADERS_JSON_ENCODED
+from .rate_limiter import THROTTLED_ATTEMPTS, getBackoff, getRetryAfter, isThrottled
+from .async_connection_pool import AsyncConnectionPool
+
+# asyncio streams are bound to their loop > every event loop gets its own pool
+POOLS = weakref.WeakKeyDictionary()
+
+
+async def request(url, data=None, headers=HEADERS, raw=False, method=None, limiter=None):
+
+	if method == "POST":
+		headers = HEADERS_JSON_ENCODED
+
+	if data and not isinstance(data, bytes):
+		data = json.dumps(data).encode("utf-8")
+
+	attempt = 0
+
+	while True:
+
+		if limiter:
+			await limiter.acquireAsync()
+
+		try:
+			# no method > GET, or POST when there's a body
+			response = await getPool().urlopen(url, data, headers, method)
+		except URLError as e:
+			throttled = isThrottled(e)
+			retryAfter = getRetryAfter(e) if throttled else None
+
+			if limiter:
+				limiter.release(throttled, retryAfter)
+
+			attempt += 1
+
+			if attempt >= (THROTTLED_ATTEMPTS if throttled else 3):
+				xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
+				return {}
+
+			await asyncio.sleep(getBackoff(attempt, retryAfter) if throttled else 1)
+			continue
+
+		if limiter:
+			limiter.release()
+
+		break
+
+	if raw:
+		return response
+
+	data = response.read().decode("utf-8")
+
+	try:
+		return json.loads(data)
+	except json.JSONDecodeError:
+		return data
+
+def getPool():
+	loop = asyncio.get_running_loop()
+	pool = POOLS.get(loop)
+
+	if not pool:
+		pool = POOLS[loop] = AsyncConnectionPool()
+
+	return pool
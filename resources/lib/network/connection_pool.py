@@ -0,0 +1,211 @@
+import io
+import time
+import threading
+import http.client
+import urllib.parse
+from urllib.error import HTTPError, URLError
+
+IDLE_TIMEOUT = 60
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError)
+
+
+class PooledResponse:
+
+	def __init__(self, pool, key, conn, response, url):
+		self.pool = pool
+		self.key = key
+		self.conn = conn
+		self.response = response
+		self.url = url
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, excTraceback):
+		self.close()
+
+	@property
+	def headers(self):
+		return self.response.headers
+
+	@property
+	def status(self):
+		return self.response.status
+
+	def close(self):
+
+		if not self.conn:
+			return
+
+		conn, self.conn = self.conn, None
+
+		if self.response.isclosed():
+			# body fully consumed > the socket can carry the next request
+			self.pool.release(self.key, conn)
+		else:
+			self.response.close()
+			conn.close()
+
+	def geturl(self):
+		return self.url
+
+	def info(self):
+		return self.response.headers
+
+	def read(self, amt=None):
+		return self.response.read(amt)
+
+	def readinto(self, buffer):
+		return self.response.readinto(buffer)
+
+
+class ConnectionPool:
+
+	def __init__(self, maxSize=10, idleTimeout=IDLE_TIMEOUT):
+		self.maxSize = maxSize
+		self.idleTimeout = idleTimeout
+		self.connections = {}
+		self.lock = threading.Lock()
+
+	def clear(self):
+
+		with self.lock:
+			connections = [conn for idle in self.connections.values() for conn, _ in idle]
+			self.connections = {}
+
+		for conn in connections:
+			conn.close()
+
+	def release(self, key, conn):
+		now = time.time()
+
+		with self.lock:
+			idle = self.connections.setdefault(key, [])
+
+			if len(idle) < self.maxSize:
+				idle.append((conn, now))
+				conn = None
+
+			expired = self._evictIdle(now)
+
+		if conn:
+			conn.close()
+
+		for conn in expired:
+			conn.close()
+
+	def setMaxSize(self, maxSize):
+		maxSize = max(1, maxSize)
+
+		with self.lock:
+			self.maxSize = maxSize
+			surplus = []
+
+			for idle in self.connections.values():
+				surplus += [conn for conn, _ in idle[maxSize:]]
+				del idle[maxSize:]
+
+		for conn in surplus:
+			conn.close()
+
+	def urlopen(self, url, data=None, headers=None, method=None):
+		headers = dict(headers or {})
+
+		if not method:
+			method = "GET" if data is None else "POST"
+
+		if data is not None:
+			headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+		for _ in range(MAX_REDIRECTS + 1):
+			response = self._send(url, method, data, headers)
+			status = response.status
+
+			if status in REDIRECT_CODES and response.headers.get("Location"):
+				response.read()
+				response.close()
+				url = urllib.parse.urljoin(url, response.headers["Location"])
+
+				if status == 303 or (status in (301, 302) and method == "POST"):
+					method, data = "GET", None
+					headers.pop("Content-Type", None)
+
+				continue
+
+			if status >= 400:
+				body = response.read()
+				response.close()
+				raise HTTPError(url, status, response.response.reason, response.headers, io.BytesIO(body))
+
+			return response
+
+		raise URLError(f"too many redirects: {url}")
+
+	def _acquire(self, key):
+		now = time.time()
+
+		with self.lock:
+			expired = self._evictIdle(now)
+			idle = self.connections.get(key)
+			conn = idle.pop()[0] if idle else None
+
+		for expiredConn in expired:
+			expiredConn.close()
+
+		if conn:
+			return conn, True
+
+		return self._connect(key), False
+
+	def _evictIdle(self, now):
+		expired = []
+
+		for key, idle in list(self.connections.items()):
+			fresh = [(conn, lastUsed) for conn, lastUsed in idle if now - lastUsed < self.idleTimeout]
+			expired += [conn for conn, lastUsed in idle if now - lastUsed >= self.idleTimeout]
+
+			if fresh:
+				self.connections[key] = fresh
+			else:
+				del self.connections[key]
+
+		return expired
+
+	def _send(self, url, method, data, headers):
+		parsedURL = urllib.parse.urlsplit(url)
+		key = (parsedURL.scheme, parsedURL.hostname, parsedURL.port)
+		path = parsedURL.path or "/"
+
+		if parsedURL.query:
+			path += f"?{parsedURL.query}"
+
+		conn, reused = self._acquire(key)
+
+		while True:
+
+			try:
+				conn.request(method, path, data, headers)
+				return PooledResponse(self, key, conn, conn.getresponse(), url)
+			except STALE_CONNECTION_ERRORS as e:
+				conn.close()
+
+				if not reused:
+					raise URLError(e)
+
+				# the server dropped an idle keep-alive socket > retry once on a fresh connection
+				conn, reused = self._connect(key), False
+
+			except (OSError, http.client.HTTPException) as e:
+				conn.close()
+				raise URLError(e)
+
+	@staticmethod
+	def _connect(key):
+		scheme, host, port = key
+
+		if scheme == "https":
+			return http.client.HTTPSConnection(host, port)
+		else:
+			return http.client.HTTPConnection(host, port)
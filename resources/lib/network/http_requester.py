@@ -1,46 +1,68 @@
 import json
-from urllib.error import URLError
-from urllib.request import Request, urlopen
+import http.client
 
 import xbmc
 
+from .connection_pool import ConnectionPool
+from .rate_limiter import THROTTLED_ATTEMPTS, getBackoff, getRetryAfter, isThrottled
+
 USER_AGENT = "Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US) AppleWebKit/532.0 (KHTML, like Gecko) Chrome/3.0.195.38 Safari/532.0"
 HEADERS = {"User-Agent": USER_AGENT}
 HEADERS_JSON_ENCODED = {"User-Agent": USER_AGENT, "Content-Type": "application/json"}
 
+# keep-alive sockets shared by every caller in the process (Drive API, TMDB/IMDB lookups, downloads)
+POOL = ConnectionPool()
+
 
-def request(url, data=None, headers=HEADERS, cookie=False, raw=False, method="GET"):
+def request(url, data=None, headers=HEADERS, cookie=False, raw=False, method=None, limiter=None):
 
 	if method == "POST":
 		headers = HEADERS_JSON_ENCODED
 
-	if data:
+	if data and not isinstance(data, bytes):
 		data = json.dumps(data).encode("utf-8")
 
-	attempts = 3
-	request = Request(url, data, headers)
+	attempt = 0
 
-	for attempt in range(attempts):
+	while True:
+
+		if limiter:
+			limiter.acquire()
 
 		try:
+			# no method > GET, or POST when there's a body
+			response = POOL.urlopen(url, data, headers, method)
 
-			response = urlopen(request)
+			if not raw:
+				responseData = response.read().decode("utf-8")
+				response.close()
 
-			if raw:
-				return response
+		except (OSError, http.client.HTTPException) as e:
+			# URLError is an OSError > a body that breaks off mid read is retried like a failed request
+			throttled = isThrottled(e)
+			retryAfter = getRetryAfter(e) if throttled else None
 
-			data = response.read().decode("utf-8")
-			response.close()
-			break
+			if limiter:
+				limiter.release(throttled, retryAfter)
 
-		except URLError as e:
-			attempts -= 1
+			attempt += 1
 
-			if not attempts:
+			# throttling is waited out with exponential backoff, anything else gets the usual 3 attempts
+			if attempt >= (THROTTLED_ATTEMPTS if throttled else 3):
 				xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
 				return {}
 
-			xbmc.sleep(1000)
+			xbmc.sleep(int(getBackoff(attempt, retryAfter) * 1000) if throttled else 1000)
+			continue
+
+		if limiter:
+			limiter.release()
+
+		if raw:
+			return response
+
+		data = responseData
+		break
 
 	if cookie:
 		cookie = response.headers["set-cookie"]
@@ -54,3 +76,6 @@ def request(url, data=None, headers=HEADERS, cookie=False, raw=False, method="GE
 		return data
 	else:
 		return data, cookie
+
+def setPoolSize(size):
+	POOL.setMaxSize(size)
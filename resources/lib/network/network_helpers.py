@@ -1,3 +1,4 @@
+import re
 import urllib.parse
 
 
@@ -7,6 +8,30 @@ def addQueryString(url, params):
 def mergePaths(baseURL, paths):
 	return f"{baseURL}/{paths}" if isinstance(paths, str) else f"{baseURL}/{'/'.join(paths)}"
 
+def parseMultipartResponse(contentType, content):
+	# splits a multipart/mixed batch response into (content ID, status, body) tuples
+	boundary = re.search('boundary="?([^";]+)"?', contentType).group(1).encode("utf-8")
+	responses = []
+
+	for part in content.split(b"--" + boundary)[1:]:
+
+		if part.startswith(b"--"):
+			break
+
+		partHeaders, _, httpResponse = part.strip().partition(b"\r\n\r\n")
+		contentID = re.search(rb"Content-ID:\s*<(?:response-)?([^>]*)>", partHeaders, re.IGNORECASE)
+		statusLine, _, httpResponse = httpResponse.partition(b"\r\n")
+		body = httpResponse[2:] if httpResponse.startswith(b"\r\n") else httpResponse.partition(b"\r\n\r\n")[2]
+
+		try:
+			status = int(statusLine.split()[1])
+		except (IndexError, ValueError):
+			continue
+
+		responses.append((contentID.group(1).decode("utf-8") if contentID else None, status, body.decode("utf-8")))
+
+	return responses
+
 def parseQuery(query):
 	return dict(urllib.parse.parse_qsl(query))
 
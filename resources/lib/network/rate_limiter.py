@@ -0,0 +1,151 @@
+import json
+import time
+import random
+import asyncio
+import threading
+import email.utils
+from urllib.error import HTTPError
+
+# drive's default per user quota is 12,000 queries a minute > AIMD only ever lowers the rate from there
+MAX_RATE = 12000 / 60
+# also what the async client keeps in flight > a lower cap here would silently bound it
+MAX_CONCURRENT = 100
+MAX_BACKOFF = 64
+THROTTLED_ATTEMPTS = 7
+THROTTLE_REASONS = ("userRateLimitExceeded", "rateLimitExceeded")
+SERVER_ERRORS = (500, 502, 503, 504)
+
+
+class RateLimiter:
+	# Token bucket per account that also caps the requests in flight. Both rate and cap are halved when
+	# Drive throttles and creep back up with every successful request (AIMD), and a Retry-After pauses
+	# every caller of the account.
+	limiters = {}
+	limitersLock = threading.Lock()
+
+	def __init__(self, maxRate=MAX_RATE, maxConcurrent=MAX_CONCURRENT):
+		self.maxRate = maxRate
+		self.rate = maxRate
+		self.tokens = maxRate
+		self.maxConcurrent = maxConcurrent
+		self.concurrent = maxConcurrent
+		self.inFlight = 0
+		self.pausedUntil = 0
+		self.updated = time.monotonic()
+		self.condition = threading.Condition()
+
+	@classmethod
+	def get(cls, key):
+
+		with cls.limitersLock:
+			limiter = cls.limiters.get(key)
+
+			if not limiter:
+				limiter = cls.limiters[key] = cls()
+
+			return limiter
+
+	def acquire(self):
+
+		with self.condition:
+
+			while True:
+				delay = self._reserve()
+
+				if delay == 0:
+					return
+
+				# None > wait for a request to finish
+				self.condition.wait(delay)
+
+	async def acquireAsync(self):
+
+		while True:
+
+			with self.condition:
+				delay = self._reserve()
+
+			if delay == 0:
+				return
+
+			await asyncio.sleep(delay or 0.05)
+
+	def release(self, throttled=False, retryAfter=None):
+
+		with self.condition:
+			self.inFlight -= 1
+
+			if throttled:
+				self.rate = max(0.5, self.rate / 2)
+				self.concurrent = max(1, self.concurrent / 2)
+
+				if retryAfter:
+					self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+
+			else:
+				self.rate = min(self.maxRate, self.rate + 0.1)
+				self.concurrent = min(self.maxConcurrent, self.concurrent + 1 / self.concurrent)
+
+			self.condition.notify_all()
+
+	def _reserve(self):
+		# returns 0 once a request may go out, otherwise how long to wait
+		now = time.monotonic()
+
+		if now < self.pausedUntil:
+			return self.pausedUntil - now
+
+		if self.inFlight >= int(self.concurrent):
+			return
+
+		self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+		if self.tokens < 1:
+			return (1 - self.tokens) / self.rate
+
+		self.tokens -= 1
+		self.inFlight += 1
+		return 0
+
+
+def getBackoff(attempt, retryAfter=None):
+	# exponential backoff with jitter unless the server said how long to wait
+	if retryAfter:
+		return retryAfter
+
+	return min(MAX_BACKOFF, 2 ** attempt) + random.random()
+
+def getRetryAfter(error):
+	value = error.headers.get("Retry-After") if error.headers else None
+
+	if not value:
+		return
+
+	try:
+		return max(0, float(value))
+	except ValueError:
+		pass
+
+	try:
+		return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return
+
+def isThrottled(error):
+
+	if not isinstance(error, HTTPError):
+		return False
+
+	if error.code == 429 or error.code in SERVER_ERRORS:
+		return True
+
+	if error.code != 403:
+		return False
+
+	try:
+		errors = json.loads(error.read())["error"]["errors"]
+	except (ValueError, KeyError, TypeError, AttributeError):
+		return False
+
+	return any(e.get("reason") in THROTTLE_REASONS for e in errors)
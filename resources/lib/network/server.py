@@ -2,11 +2,9 @@ import os
 import re
 import json
 import time
-import datetime
 from threading import Thread
 from urllib.error import URLError
 from urllib.parse import unquote_plus
-from urllib.request import Request, urlopen
 from socketserver import ThreadingMixIn
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
@@ -21,10 +19,19 @@ from ..accounts.account_manager import AccountManager
 from ..sync.task_manager import TaskManager
 from ..sync.sync_cache_manager import SyncCacheManager
 from ..encryption.encryptor import Encryptor
+from ..playback.prefetcher import Prefetcher
 from ..playback.video_player import VideoPlayer
+from ..playback.range_reader import RangeReader
+from ..playback.segment_cache import SEGMENT_SIZE, SegmentCache
+from ..playback.stream_session import StreamSession, StreamSessions
 from ..google_api.google_drive import GoogleDrive
 from ..filesystem.file_operations import FileOperations
 
+# seconds of playback before the next episode is prefetched > skipping through episodes doesn't warm each one
+PREFETCH_DELAY = 30
+# a small first chunk gets data to kodi quickly after a seek > the following ones double up to the configured size
+FIRST_CHUNK_SIZE = 64 * 1024
+
 
 class ServerRunner(Thread):
 
@@ -42,6 +49,7 @@ class ServerRunner(Thread):
 			self.server_close()
 
 	def shutdown(self):
+		self.server.taskManager.stop()
 		self.server.shutdown()
 		self.server.server_close()
 
@@ -59,25 +67,14 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
 		self.taskManager.run()
 		self.fileOperations = FileOperations()
 		self.dialog = Dialog()
+		self.streamSessions = StreamSessions()
+		self.segmentCache = SegmentCache(os.path.join(ADDON_PATH, "stream_cache"))
+		self.prefetcher = Prefetcher(self.accountManager, self.settings, self.segmentCache)
 		self.shutdownRequest = False
-		self.failed = False
 
 
 class ServerHandler(BaseHTTPRequestHandler):
 
-	def createRequest(self, start, end, startOffset):
-
-		if start == "":
-			return Request(self.server.url, headers=self.server.cloudService.getHeaders())
-		else:
-			return Request(
-				self.server.url,
-				headers=self.server.cloudService.getHeaders(
-					additionalHeader="Range",
-					additionalValue=f"bytes={start - startOffset}-{end}",
-				)
-			)
-
 	def decryptStream(self, response, startOffset):
 		decrypt = Encryptor(self.server.settings.getSetting("crypto_salt"), self.server.settings.getSetting("crypto_password"))
 
@@ -137,6 +134,7 @@ class ServerHandler(BaseHTTPRequestHandler):
 		cid = postData["cid"]
 		self.server.taskManager.removeAllTasks()
 		syncRoot = self.server.cache.getSyncRootPath() or self.server.settings.getSetting("sync_root")
+		self.server.cache.closeConnections()
 
 		for _ in range(3):
 			deleted = self.server.fileOperations.deleteFile(filePath=os.path.join(ADDON_PATH, "sync_cache.db"))
@@ -146,6 +144,9 @@ class ServerHandler(BaseHTTPRequestHandler):
 
 			time.sleep(0.1)
 
+		for walFile in ("sync_cache.db-wal", "sync_cache.db-shm"):
+			self.server.fileOperations.deleteFile(filePath=os.path.join(ADDON_PATH, walFile))
+
 		if not deleted:
 			self.server.dialog.ok(self.server.settings.getLocalizedString(30000), self.server.settings.getLocalizedString(30056))
 			return
@@ -192,22 +193,39 @@ class ServerHandler(BaseHTTPRequestHandler):
 
 		self.server.taskManager.run()
 
+	def getRangeReader(self, session, start, end):
+		# parallel range requests for bitrates a single connection can't keep up with > None if they're off
+		connections = self.server.settings.getSettingInt("stream_connections", 1)
+
+		if connections > 1 and session.length:
+			pieceSize = self.server.settings.getSettingInt("stream_segment_size", 8) * 1024 * 1024
+			return RangeReader(session, start, end, pieceSize, connections)
+
+	def getSession(self, path):
+		# /play/<session ID> > None if the session is unknown or has expired
+		sessionID = path[len("/play/"):] if path.startswith("/play/") else None
+		return self.server.streamSessions.get(sessionID)
+
 	def handleInitializeStream(self):
 		postData = self.getPostDataJSON()
-		self.handleResponse(200)
-		self.server.failed = False
-		self.server.url = postData["url"]
-		self.server.driveID = postData["drive_id"]
-		self.server.fileID = postData["file_id"]
-		self.server.encrypted = postData["encrypted"]
-		self.server.transcoded = postData["transcoded"]
 		self.server.accountManager.setAccounts()
-		account = self.server.accountManager.getAccount(self.server.driveID)
-		self.server.cloudService.setAccount(account)
+		# the session warmed up while the previous episode played
+		session = self.server.prefetcher.take(postData["file_id"], postData["drive_id"], postData["encrypted"], postData["transcoded"])
+
+		if not session:
+			account = self.server.accountManager.getAccount(postData["drive_id"])
+			session = StreamSession(account, postData["url"], postData["drive_id"], postData["file_id"], postData["encrypted"], postData["transcoded"])
+
+		self.server.streamSessions.add(session)
+		self.handleResponse(200, {"Content-Type": "application/json"}, json.dumps({"session_id": session.id}))
 
-	def handlePlayRequest(self):
+	def handlePlayRequest(self, session):
+
+		if not session:
+			self.send_error(404)
+			return
 
-		if self.server.failed:
+		if session.failed:
 			return
 
 		try:
@@ -218,20 +236,26 @@ class ServerHandler(BaseHTTPRequestHandler):
 			start = ""
 			end = ""
 
+		if not session.encrypted:
+			self.sendStreamResponse(session, start, end)
+			return
+
 		startOffset = 0
 
-		if self.server.encrypted and start != "" and start > 16 and end == "":
-			startOffset = 16 - ((int(self.server.length) - start) % 16) + 8
+		if start != "" and start > 16 and end == "":
+			startOffset = 16 - ((int(session.length) - start) % 16) + 8
 
-		req = self.createRequest(start, end, startOffset)
+		response = self.getRangeReader(session, start - startOffset if start != "" else 0, end if end != "" else int(session.length or 0) - 1)
 
-		try:
-			response = urlopen(req)
-		except URLError as e:
-			xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
-			return
+		if not response:
 
-		self.sendPlayResponse(start, end, response, startOffset)
+			try:
+				response = self.openRange(session, start, end, startOffset)
+			except URLError as e:
+				xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
+				return
+
+		self.sendPlayResponse(session, start, end, response, startOffset)
 
 	def handleRegisterRequest(self):
 		self.handleResponse(200, data=registration.form)
@@ -255,7 +279,9 @@ class ServerHandler(BaseHTTPRequestHandler):
 		if headers:
 
 			for header, value in headers.items():
-				self.send_header(header, value)
+
+				if value is not None:
+					self.send_header(header, value)
 
 		self.end_headers()
 
@@ -318,21 +344,32 @@ class ServerHandler(BaseHTTPRequestHandler):
 		self.handleResponse(200)
 		dbID = postData["db_id"]
 		dbType = postData["db_type"]
+		sessionID = postData.get("session_id")
 		trackProgress = dbID is not None
 		player = VideoPlayer(dbID, dbType, trackProgress)
+		session = None
+		prefetchTime = time.time() + PREFETCH_DELAY
+		prefetch = dbType == "episode" and dbID and self.server.settings.getSetting("prefetch_next_episode")
 
 		while not self.server.monitor.abortRequested() and not player.close:
+			# looking the session up also keeps it from expiring while it's played
+			session = self.server.streamSessions.get(sessionID)
 
-			if datetime.datetime.now() >= self.server.cloudService.account.expiry:
+			if not session:
+				break
 
-				self.server.cloudService.refreshToken()
+			session.refreshToken()
 
-				if self.server.transcoded:
-					self.server.url = self.server.cloudService.getStreams(self.server.fileID, (self.server.transcoded,))[1]
+			if prefetch and time.time() >= prefetchTime:
+				prefetch = False
+				self.server.prefetcher.prefetch(int(dbID))
 
 			if self.server.monitor.waitForAbort(1):
 				break
 
+		if session and session.cacheKey:
+			self.server.segmentCache.unpin(session.cacheKey)
+
 	def handleStatusRequest(self, query):
 		code = query.get("code")
 
@@ -414,7 +451,17 @@ class ServerHandler(BaseHTTPRequestHandler):
 				self.server.settings.getLocalizedString(30044),
 			)
 
-	def sendPlayResponse(self, start, end, response, startOffset):
+	def openRange(self, session, start, end, startOffset):
+		# encrypted ranges go over the session's keep-alive connections as well > the decryptor reads a response to
+		# its end, so unlike streamResponse a range never continues on a parked one
+
+		if start == "":
+			return session.pool.urlopen(session.url, headers=session.cloudService.getHeaders())
+
+		headers = session.cloudService.getHeaders(additionalHeader="Range", additionalValue=f"bytes={start - startOffset}-{end}")
+		return session.pool.urlopen(session.url, headers=headers)
+
+	def sendPlayResponse(self, session, start, end, response, startOffset):
 
 		if start == "":
 			self.handleResponse(200, {
@@ -427,18 +474,14 @@ class ServerHandler(BaseHTTPRequestHandler):
 		else:
 			self.handleResponse(206, {
 				"Content-Length": str(int(response.info().get("Content-Length")) - startOffset),
-				"Content-Range": f"bytes {start}-{end}/{self.server.length}" if end else f"bytes {start}-{int(self.server.length) - 1}/{self.server.length}",
+				"Content-Range": f"bytes {start}-{end}/{session.length}" if end else f"bytes {start}-{int(session.length) - 1}/{session.length}",
 				"Content-Type": response.info().get("Content-Type"),
 				"Cache-Control": response.info().get("Cache-Control"),
 				"Date": response.info().get("Date"),
 				"Accept-Ranges": "bytes",
 			})
 
-		if self.server.encrypted:
-			self.decryptStream(response, startOffset)
-		else:
-			self.streamResponse(response)
-
+		self.decryptStream(response, startOffset)
 		response.close()
 
 	def sendRedirect(self, location):
@@ -446,25 +489,129 @@ class ServerHandler(BaseHTTPRequestHandler):
 		self.send_header("Location", location)
 		self.end_headers()
 
-	def streamResponse(self, response):
-		CHUNK = 16 * 1024
+	def sendStreamResponse(self, session, start, end):
+
+		if not session.length:
+
+			try:
+				# the length is normally known from the HEAD request > the response is kept for the body
+				session.park(session.openRange(start or 0)[0])
+			except URLError as e:
+				xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
+				return
+
+		length = int(session.length)
+		last = min(end, length - 1) if end != "" else length - 1
+
+		if start == "":
+			code, headers = 200, {"Content-Length": str(length)}
+		else:
+			code, headers = 206, {"Content-Length": str(last - start + 1), "Content-Range": f"bytes {start}-{last}/{length}"}
+
+		headers.update({
+			"Content-Type": session.contentType or "application/octet-stream",
+			"Accept-Ranges": "bytes",
+		})
+		self.handleResponse(code, headers)
+		self.streamResponse(session, start or 0, last)
+
+	def streamResponse(self, session, position, last):
+		# cached segments are sent straight from disk, the gaps are fetched from drive. a segment that's read
+		# from its first byte is stored on the way through, even when the requested range ends inside it
+		cache = self.server.segmentCache
+		cache.setMaxSize(self.server.settings.getSettingInt("stream_cache_size", 1024) * 1024 * 1024)
+		key = session.getCacheKey() if cache.maxSize else ""
+		length = int(session.length)
+		# every chunk is read into the same buffer and written out of it without a copy
+		buffer = memoryview(bytearray(self.server.settings.getSettingInt("stream_chunk_size", 1024) * 1024))
+		segment = memoryview(bytearray(SEGMENT_SIZE)) if key else None
+		chunkSize = FIRST_CHUNK_SIZE
+		upstream = None
+
+		if key:
+			cache.pin(key, length)
 
 		try:
 
-			while True:
-				chunk = response.read(CHUNK)
+			while position <= last:
+				index, offset = divmod(position, SEGMENT_SIZE)
+				segmentEnd = min((index + 1) * SEGMENT_SIZE, length) - 1
+				segmentPath = cache.get(key, index) if key else None
 
-				if not chunk:
-					break
+				if upstream and upstream.position > upstream.end:
+					session.park(upstream)
+					upstream = None
+
+				if segmentPath:
+
+					if upstream:
+						session.park(upstream)
+						upstream = None
+
+					size = min(segmentEnd, last) - position + 1
+
+					try:
+
+						with open(segmentPath, "rb") as file:
+							# zero copy from the page cache to the socket
+							sent = self.connection.sendfile(file, offset, size)
+
+					except FileNotFoundError:
+						# evicted in the meantime or removed behind the cache's back > the gap is fetched from drive
+						cache.discard(key, index)
+						continue
+
+					position += sent
+
+					if sent < size:
+						# the segment file is short > it's dropped and the rest of it comes from drive
+						cache.discard(key, index)
+
+					continue
+
+				if not upstream:
+					# the gap runs up to the next cached segment
+					gapIndex = index
+
+					while key and gapIndex < last // SEGMENT_SIZE and not cache.contains(key, gapIndex + 1):
+						gapIndex += 1
+
+					gapEnd = min((gapIndex + 1) * SEGMENT_SIZE, length) - 1 if key else last
+					upstream = self.getRangeReader(session, position, gapEnd) or session.openRange(position)[0]
 
-				self.wfile.write(chunk)
+				store = key and not offset
+				stop = segmentEnd if store else min(segmentEnd, last)
+
+				while position <= stop:
+					chunk = buffer[:min(chunkSize, len(buffer), stop - position + 1)]
+					read = upstream.readinto(chunk)
+
+					if not read:
+						return
+
+					if position <= last:
+						self.wfile.write(chunk[:min(read, last - position + 1)])
+
+					if store:
+						segment[position - index * SEGMENT_SIZE:position - index * SEGMENT_SIZE + read] = chunk[:read]
+
+					position += read
+					chunkSize *= 2
+
+				if store:
+					cache.add(key, index, segment[:segmentEnd - index * SEGMENT_SIZE + 1])
 
 		except Exception as e:
 			xbmc.log(str(e))
 
+		finally:
+
+			if upstream:
+				# whatever kodi didn't read stays open for a range that continues from there
+				session.park(upstream)
+
 	def do_GET(self):
 		pathHandlers = {
-			"/play": self.handlePlayRequest,
 			"/delete_accounts_file": self.handleDeleteAccountsFile,
 			"/register": self.handleRegisterRequest,
 			"/registration_failed": self.handleRegistrationFailed,
@@ -477,19 +624,33 @@ class ServerHandler(BaseHTTPRequestHandler):
 		query = parsedURL["query"]
 		handler = pathHandlers.get(path)
 
-		if handler:
+		if path.startswith("/play/"):
+			self.handlePlayRequest(self.getSession(path))
+		elif handler:
 			handler()
 		else:
 			self.send_error(404)
 
 	def do_HEAD(self):
-		req = Request(self.server.url, headers=self.server.cloudService.getHeaders())
-		req.get_method = lambda: "HEAD"
+		session = self.getSession(parseURL(self.path)["path"])
+
+		if not session:
+			self.send_error(404)
+			return
+
+		# a prefetched session already knows its length > kodi gets its answer without a round trip to drive
+		if session.length and not session.failed:
+			self.handleResponse(200, {
+				"Content-Length": session.length,
+				"Content-Type": session.contentType,
+				"Accept-Ranges": "bytes",
+			})
+			return
 
 		try:
-			response = urlopen(req)
+			response = session.pool.urlopen(session.url, headers=session.cloudService.getHeaders(), method="HEAD")
 		except URLError as e:
-			self.server.failed = True
+			session.failed = True
 
 			if e.code == 404:
 				self.server.dialog.ok(self.server.settings.getLocalizedString(30003), self.server.settings.getLocalizedString(30209))
@@ -499,23 +660,15 @@ class ServerHandler(BaseHTTPRequestHandler):
 				return
 			elif e.code == 403 or e.code == 429:
 				accountChange = False
-				accounts = self.server.accountManager.getAccounts(self.server.driveID)
+				accounts = self.server.accountManager.getAccounts(session.driveID)
 
 				for account in accounts[1:]:
-					self.server.cloudService.setAccount(account)
-					tokenRefresh = self.server.cloudService.refreshToken()
 
-					if not tokenRefresh:
+					if not session.setAccount(account):
 						continue
 
-					if self.server.transcoded:
-						self.server.url = self.server.cloudService.getStreams(self.server.fileID, (self.server.transcoded,))[1]
-
-					req = Request(self.server.url, headers=self.server.cloudService.getHeaders())
-					req.get_method = lambda: "HEAD"
-
 					try:
-						response = urlopen(req)
+						response = session.pool.urlopen(session.url, headers=session.cloudService.getHeaders(), method="HEAD")
 					except URLError:
 						continue
 
@@ -541,7 +694,7 @@ class ServerHandler(BaseHTTPRequestHandler):
 				xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
 				return
 
-		self.server.failed = False
+		session.failed = False
 		self.handleResponse(200, {
 			"Content-Length": response.info().get("Content-Length"),
 			"Content-Type": response.info().get("Content-Type"),
@@ -549,8 +702,11 @@ class ServerHandler(BaseHTTPRequestHandler):
 			"Date": response.info().get("Date"),
 			"Accept-Ranges": "bytes",
 		})
+		# reading the empty body hands the socket back to the session's pool
+		response.read()
 		response.close()
-		self.server.length = response.info().get("Content-Length")
+		session.length = response.info().get("Content-Length")
+		session.contentType = response.info().get("Content-Type")
 
 	def do_POST(self):
 		pathHandlers = {
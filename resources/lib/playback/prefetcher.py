@@ -0,0 +1,183 @@
+import threading
+from urllib.error import URLError
+
+import xbmc
+
+from .segment_cache import SEGMENT_SIZE
+from .stream_session import StreamSession
+from ..google_api.google_drive import GoogleDrive
+from ..network.network_helpers import parseURL
+from ..filesystem.file_operations import FileOperations
+from helpers import sendJSONRPCCommand
+
+# the start of the next episode that's fetched ahead of time
+PREFETCH_SEGMENTS = 4
+
+
+class Prefetcher:
+	# Warms the stream of the episode that follows the one playing. Its session is set up in the background
+	# with the account, URL and length resolved and its first segments are put in the segment cache, then
+	# /initialize_stream hands out that session instead of a cold one once kodi moves on to the episode.
+
+	def __init__(self, accountManager, settings, segmentCache):
+		self.accountManager = accountManager
+		self.settings = settings
+		self.segmentCache = segmentCache
+		self.sessions = {}
+		self.lock = threading.Lock()
+
+	def prefetch(self, episodeID):
+		threading.Thread(target=self._prefetch, args=(episodeID,), daemon=True).start()
+
+	def take(self, fileID, driveID, encrypted, transcoded):
+
+		with self.lock:
+			session = self.sessions.pop(fileID, None)
+
+		if not session:
+			return
+
+		# the token was refreshed while the previous episode played > it may well have expired since
+		if session.driveID == driveID and session.encrypted == encrypted and session.transcoded == transcoded and session.refreshToken():
+			return session
+
+		session.close()
+
+	@staticmethod
+	def _getNextEpisode(episodeID):
+		query = {
+			"jsonrpc": "2.0",
+			"id": 1,
+			"method": "VideoLibrary.GetEpisodeDetails",
+			"params": {"episodeid": episodeID, "properties": ["tvshowid", "season", "episode"]},
+		}
+		episode = sendJSONRPCCommand(query).get("result", {}).get("episodedetails")
+
+		if not episode:
+			return
+
+		query = {
+			"jsonrpc": "2.0",
+			"id": 1,
+			"method": "VideoLibrary.GetEpisodes",
+			"params": {"tvshowid": episode["tvshowid"], "properties": ["season", "episode", "file"]},
+		}
+		episodes = sendJSONRPCCommand(query).get("result", {}).get("episodes", [])
+		current = episode["season"], episode["episode"]
+		# specials (season 0) aren't part of the running order
+		following = [e for e in episodes if (e["season"], e["episode"]) > current and (e["season"] or not current[0])]
+		return min(following, key=lambda e: (e["season"], e["episode"]), default=None)
+
+	def _getStreamParams(self, filePath):
+		# the file ID, drive ID and encryption flag that the episode's strm passes to the plugin
+		contents = FileOperations.readFile(filePath) if filePath.endswith(".strm") else None
+
+		if not contents or not contents.startswith("plugin://plugin.video.gdrive/"):
+			return
+
+		params = parseURL(contents.strip())["query"]
+
+		if not params or not params.get("file_id"):
+			return
+
+		if self.settings.getSetting("account_selection") == "Manually selected":
+			driveID = self.settings.getSetting("playback_account")
+		else:
+			driveID = params.get("drive_id")
+
+		return params["file_id"], driveID, params.get("encrypted", "").lower() == "true"
+
+	def _prefetch(self, episodeID):
+		episode = self._getNextEpisode(episodeID)
+
+		if not episode:
+			return
+
+		params = self._getStreamParams(episode["file"])
+
+		if not params:
+			return
+
+		fileID, driveID, encrypted = params
+
+		# playVideo picks a transcoded stream in these cases > the original wouldn't be used
+		if not encrypted and (self.settings.getSetting("resolution_prompt") or self.settings.getSetting("resolution_priority").split(", ")[0] != "Original"):
+			return
+
+		with self.lock:
+
+			if fileID in self.sessions:
+				return
+
+		account = self.accountManager.getAccount(driveID)
+
+		if not account:
+			return
+
+		session = StreamSession(account, GoogleDrive.getDownloadURL(fileID), driveID, fileID, encrypted, False)
+
+		try:
+
+			if not session.refreshToken():
+				return
+
+			response = session.pool.urlopen(session.url, headers=session.cloudService.getHeaders(), method="HEAD")
+			response.read()
+			response.close()
+			session.length = response.info().get("Content-Length")
+			session.contentType = response.info().get("Content-Type")
+
+			self.segmentCache.setMaxSize(self.settings.getSettingInt("stream_cache_size", 1024) * 1024 * 1024)
+
+			# decrypted streams aren't cached
+			if not encrypted and self.segmentCache.maxSize:
+				self._prefetchSegments(session)
+
+		except (URLError, OSError, ValueError) as e:
+			xbmc.log(f"gdrive error: {e}", xbmc.LOGERROR)
+			session.close()
+			return
+
+		with self.lock:
+			# only the episode after the latest one that played stays warm
+			sessions, self.sessions = self.sessions, {fileID: session}
+
+		for session in sessions.values():
+			session.close()
+
+	def _prefetchSegments(self, session):
+		key = session.getCacheKey()
+		length = int(session.length)
+
+		if not key:
+			return
+
+		self.segmentCache.pin(key, length)
+		indexes = [index for index in range(min(PREFETCH_SEGMENTS, (length - 1) // SEGMENT_SIZE + 1)) if not self.segmentCache.contains(key, index)]
+
+		if not indexes:
+			return
+
+		start = indexes[0] * SEGMENT_SIZE
+		end = min((indexes[-1] + 1) * SEGMENT_SIZE, length) - 1
+		upstream, _ = session.openRange(start, end)
+
+		try:
+
+			for index in range(indexes[0], indexes[-1] + 1):
+				size = min((index + 1) * SEGMENT_SIZE, length) - index * SEGMENT_SIZE
+				segment = memoryview(bytearray(size))
+				read = 0
+
+				while read < size:
+					chunk = upstream.readinto(segment[read:])
+
+					if not chunk:
+						return
+
+					read += chunk
+
+				self.segmentCache.add(key, index, segment)
+
+		finally:
+			upstream.close()
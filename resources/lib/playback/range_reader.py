@@ -0,0 +1,105 @@
+import collections
+from urllib.error import URLError
+
+from .segment_cache import SEGMENT_SIZE
+from ..threadpool.threadpool import EXECUTOR, PRIORITY_URGENT
+
+
+class RangeReader:
+	# Reads [start, end] of a stream as consecutive pieces fetched over up to `connections` parallel range
+	# requests. Pieces are handed out in order and at most `connections` of them are held in memory, so the
+	# read-ahead follows the pace of the client. Works like a response for streamResponse and the decryptor.
+
+	def __init__(self, session, start, end, pieceSize, connections):
+		self.session = session
+		self.position = start
+		self.end = end
+		self.pieceSize = pieceSize
+		self.connections = connections
+		self.next = start
+		self.pending = collections.deque()
+		self.piece = memoryview(b"")
+		self.headers = {"Content-Length": str(end - start + 1), "Content-Type": session.contentType}
+		session.pool.setMaxSize(connections)
+		self._fill()
+
+	def close(self):
+
+		for future in self.pending:
+			future.cancel()
+
+		self.pending.clear()
+
+	def info(self):
+		return self.headers
+
+	def read(self, size):
+		# fills the whole size unless the range ends > the decryptor relies on full blocks
+		buffer = bytearray(size)
+		view = memoryview(buffer)
+		read = 0
+
+		while read < size:
+			chunk = self.readinto(view[read:])
+
+			if not chunk:
+				break
+
+			read += chunk
+
+		return bytes(buffer[:read])
+
+	def readinto(self, buffer):
+		# a short read only means the current piece ended
+
+		if not self.piece:
+
+			if not self.pending:
+				return 0
+
+			self.piece = memoryview(self.pending.popleft().result())
+			self._fill()
+
+		size = min(len(buffer), len(self.piece))
+		buffer[:size] = self.piece[:size]
+		self.piece = self.piece[size:]
+		self.position += size
+		return size
+
+	def _fill(self):
+
+		while len(self.pending) < self.connections and self.next <= self.end:
+			# the first piece only runs up to the next segment boundary so a seek gets its first bytes quickly,
+			# the following ones stay aligned to the segment cache
+			if self.next % SEGMENT_SIZE:
+				pieceEnd = (self.next // SEGMENT_SIZE + 1) * SEGMENT_SIZE - 1
+			else:
+				pieceEnd = self.next + self.pieceSize - 1
+
+			pieceEnd = min(pieceEnd, self.end)
+			# ahead of every queued sync task on the shared executor
+			self.pending.append(EXECUTOR.submit(self._fetch, self.next, pieceEnd, priority=PRIORITY_URGENT))
+			self.next = pieceEnd + 1
+
+	def _fetch(self, start, end):
+		headers = self.session.cloudService.getHeaders(additionalHeader="Range", additionalValue=f"bytes={start}-{end}")
+		attempts = 2
+
+		for attempt in range(attempts):
+
+			try:
+
+				with self.session.pool.urlopen(self.session.url, headers=headers) as response:
+					data = response.read()
+
+			except URLError:
+
+				if attempt == attempts - 1:
+					raise
+
+				continue
+
+			if len(data) == end - start + 1:
+				return data
+
+		raise URLError(f"incomplete range {start}-{end}")
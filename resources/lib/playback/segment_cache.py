@@ -0,0 +1,162 @@
+import os
+import re
+import tempfile
+import threading
+import collections
+
+SEGMENT_SIZE = 1024 * 1024
+# the container headers at the start of a file and the index (mkv cues, mp4 moov) kodi probes at its end
+PINNED_HEAD_SEGMENTS = 8
+PINNED_TAIL_SEGMENTS = 4
+MAX_PINNED_FILES = 4
+
+
+class SegmentCache:
+	# Fixed size, aligned segments of streamed files kept on disk, one file per segment so evicting one
+	# frees its space right away. Segments are keyed by file ID and modified time, the least recently
+	# served ones are evicted once the cache outgrows maxSize and the head and tail segments of a file
+	# that's playing are pinned. The index is rebuilt from the directory on start.
+
+	def __init__(self, path, maxSize=0):
+		self.path = path
+		self.maxSize = maxSize
+		self.size = 0
+		self.segments = collections.OrderedDict()
+		self.pinned = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+		if not os.path.exists(path):
+			os.makedirs(path)
+
+		self._load()
+
+	def add(self, key, index, data):
+		filePath = self._getPath(key, index)
+		tempPath = None
+
+		try:
+			# kodi's probe and demuxer can store the same segment at once > every write gets its own temp file
+			descriptor, tempPath = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+
+			with os.fdopen(descriptor, "wb") as file:
+				file.write(data)
+
+			os.replace(tempPath, filePath)
+		except OSError:
+
+			if tempPath:
+				self._remove(tempPath)
+
+			return
+
+		with self.lock:
+			self.size += len(data) - self.segments.pop((key, index), 0)
+			self.segments[(key, index)] = len(data)
+			expired = self._evict()
+
+		for filePath in expired:
+			self._remove(filePath)
+
+	def contains(self, key, index):
+		return (key, index) in self.segments
+
+	def discard(self, key, index):
+
+		with self.lock:
+			size = self.segments.pop((key, index), None)
+
+			if size is None:
+				return
+
+			self.size -= size
+
+		self._remove(self._getPath(key, index))
+
+	def get(self, key, index):
+
+		with self.lock:
+
+			if (key, index) not in self.segments:
+				return
+
+			self.segments.move_to_end((key, index))
+
+		return self._getPath(key, index)
+
+	@staticmethod
+	def getKey(fileID, modifiedTime, variant):
+		return re.sub(r"\W", "", f"{fileID}_{modifiedTime}_{variant}")
+
+	def pin(self, key, length):
+
+		with self.lock:
+			self.pinned[key] = (int(length) - 1) // SEGMENT_SIZE
+			self.pinned.move_to_end(key)
+
+			# a stream that never reached the player isn't unpinned > only the latest files stay pinned
+			while len(self.pinned) > MAX_PINNED_FILES:
+				self.pinned.popitem(last=False)
+
+	def setMaxSize(self, maxSize):
+
+		with self.lock:
+			self.maxSize = maxSize
+			expired = self._evict()
+
+		for filePath in expired:
+			self._remove(filePath)
+
+	def unpin(self, key):
+
+		with self.lock:
+			self.pinned.pop(key, None)
+
+	def _evict(self):
+		expired = []
+
+		for key, index in list(self.segments):
+
+			if self.size <= self.maxSize:
+				break
+
+			if self._isPinned(key, index):
+				continue
+
+			self.size -= self.segments.pop((key, index))
+			expired.append(self._getPath(key, index))
+
+		return expired
+
+	def _getPath(self, key, index):
+		return os.path.join(self.path, f"{key}.{index}")
+
+	def _isPinned(self, key, index):
+		lastIndex = self.pinned.get(key)
+		return lastIndex is not None and (index < PINNED_HEAD_SEGMENTS or index > lastIndex - PINNED_TAIL_SEGMENTS)
+
+	def _load(self):
+		segments = []
+
+		for filename in os.listdir(self.path):
+			filePath = os.path.join(self.path, filename)
+			key, _, index = filename.rpartition(".")
+
+			if not index.isdigit():
+				# an interrupted write
+				self._remove(filePath)
+				continue
+
+			stat = os.stat(filePath)
+			segments.append((stat.st_mtime, key, int(index), stat.st_size))
+
+		for _, key, index, size in sorted(segments):
+			self.segments[(key, index)] = size
+			self.size += size
+
+	@staticmethod
+	def _remove(filePath):
+
+		try:
+			os.remove(filePath)
+		except OSError:
+			pass
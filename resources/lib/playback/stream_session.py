@@ -0,0 +1,207 @@
+import re
+import time
+import uuid
+import datetime
+import threading
+import collections
+
+from .segment_cache import SegmentCache
+from ..google_api.google_drive import GoogleDrive
+from ..network.connection_pool import IDLE_TIMEOUT, ConnectionPool
+
+MAX_SESSIONS = 10
+SESSION_TIMEOUT = 6 * 3600
+
+
+class Upstream:
+	# a range response from drive and the file offset of its next unread byte > end is the last offset it covers
+
+	def __init__(self, response, position, end):
+		self.response = response
+		self.position = position
+		self.end = end
+		self.parked = None
+
+	def close(self):
+		self.response.close()
+
+	def info(self):
+		return self.response.info()
+
+	def readinto(self, buffer):
+		size = self.response.readinto(buffer)
+		self.position += size
+		return size
+
+
+class StreamSession:
+	# State of one stream served on /play/<session ID>. Every session has its own GoogleDrive, so token
+	# refreshes and account switches of one playback never touch the URL or headers of another.
+
+	def __init__(self, account, url, driveID, fileID, encrypted, transcoded):
+		self.id = uuid.uuid4().hex
+		self.cloudService = GoogleDrive()
+		self.cloudService.setAccount(account)
+		self.url = url
+		self.driveID = driveID
+		self.fileID = fileID
+		self.encrypted = encrypted
+		self.transcoded = transcoded
+		self.length = None
+		self.contentType = None
+		self.failed = False
+		self.lastUsed = time.time()
+		self.lock = threading.Lock()
+		# keep-alive sockets to drive used by this stream only, and the unfinished response of the last range
+		self.pool = ConnectionPool(maxSize=2)
+		self.upstream = None
+		self.cacheKey = None
+
+	def close(self):
+
+		with self.lock:
+			upstream, self.upstream = self.upstream, None
+
+		if upstream:
+			upstream.close()
+
+		self.pool.clear()
+
+	def getCacheKey(self):
+		# segments are only valid for the revision of the file they were read from > empty if that's unknown
+
+		with self.lock:
+
+			if self.cacheKey is None:
+				modifiedTime = self.cloudService.getModifiedTime(self.fileID)
+				self.cacheKey = SegmentCache.getKey(self.fileID, modifiedTime, self.transcoded or "original") if modifiedTime else ""
+
+			return self.cacheKey
+
+	def openRange(self, start, end=None):
+		# kodi reads a file as a series of ranges > a range starting where the previous one stopped reading
+		# continues on its response instead of waiting on a new request. returns (upstream, reused)
+
+		with self.lock:
+			upstream, self.upstream = self.upstream, None
+
+		if upstream:
+			last = end if end is not None else int(self.length) - 1
+
+			if upstream.position == start and last <= upstream.end and time.time() - upstream.parked < IDLE_TIMEOUT:
+				return upstream, True
+
+			upstream.close()
+
+		rangeEnd = "" if end is None else end
+		headers = self.cloudService.getHeaders(additionalHeader="Range", additionalValue=f"bytes={start}-{rangeEnd}")
+		response = self.pool.urlopen(self.url, headers=headers)
+		contentRange = re.match(r"bytes (\d+)-(\d+)/(\d+)", response.info().get("Content-Range") or "")
+
+		if contentRange:
+			start, last, length = map(int, contentRange.group(1, 2, 3))
+		else:
+			# the whole file
+			length = int(response.info().get("Content-Length"))
+			start, last = 0, length - 1
+
+		if not self.length:
+			self.length = str(length)
+			self.contentType = response.info().get("Content-Type")
+
+		return Upstream(response, start, last), False
+
+	def park(self, upstream):
+		# keeps a response that still has bytes left for the range that follows > parallel readers can't be resumed
+
+		if not isinstance(upstream, Upstream) or upstream.position > upstream.end:
+			upstream.close()
+			return
+
+		upstream.parked = time.time()
+
+		with self.lock:
+			upstream, self.upstream = self.upstream, upstream
+
+		if upstream:
+			upstream.close()
+
+	def refreshToken(self, force=False):
+		# a transcoded stream URL is tied to the access token > it's resolved again with the new one
+
+		with self.lock:
+
+			if not force and datetime.datetime.now() < self.cloudService.account.expiry:
+				return True
+
+			if not self.cloudService.refreshToken():
+				return False
+
+			if self.transcoded:
+				self.url = self.cloudService.getStreams(self.fileID, (self.transcoded,))[1]
+
+			return True
+
+	def setAccount(self, account):
+		self.cloudService.setAccount(account)
+		return self.refreshToken(force=True)
+
+
+class StreamSessions:
+	# LRU of the stream sessions. Looking a session up marks it as used, the least recently used one is dropped
+	# once there are more than maxSessions and sessions left idle for longer than the timeout expire.
+
+	def __init__(self, maxSessions=MAX_SESSIONS, timeout=SESSION_TIMEOUT):
+		self.maxSessions = maxSessions
+		self.timeout = timeout
+		self.sessions = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def add(self, session):
+
+		with self.lock:
+			self.sessions[session.id] = session
+			expired = self._expire()
+
+		for expiredSession in expired:
+			expiredSession.close()
+
+		return session
+
+	def get(self, sessionID):
+		# sessions that timed out are dropped first > an expired ID gets None like an unknown one
+
+		with self.lock:
+			expired = self._expire()
+			session = self.sessions.get(sessionID)
+
+			if session:
+				session.lastUsed = time.time()
+				self.sessions.move_to_end(sessionID)
+
+		for expiredSession in expired:
+			expiredSession.close()
+
+		return session
+
+	def remove(self, sessionID):
+
+		with self.lock:
+			session = self.sessions.pop(sessionID, None)
+
+		if session:
+			session.close()
+
+	def _expire(self):
+		now = time.time()
+		expired = []
+
+		for sessionID, session in list(self.sessions.items()):
+
+			if now - session.lastUsed > self.timeout:
+				expired.append(self.sessions.pop(sessionID))
+
+		while len(self.sessions) > self.maxSessions:
+			expired.append(self.sessions.popitem(last=False)[1])
+
+		return expired
@@ -0,0 +1,38 @@
+def coalesceChanges(changes):
+	# drive lists a file once per change in the window (upload, metadata processed, rename...) > only the
+	# final state of every ID is kept, in the order of its last change
+	latest = {}
+
+	for change in changes:
+		item = change.get("file")
+
+		if not item:
+			continue
+
+		latest.pop(item["id"], None)
+		latest[item["id"]] = change
+
+	return list(latest.values())
+
+def sortByDepth(folders):
+	# parents before their children > a moved or new parent carries its subtree along, so the changes of the
+	# children that follow it no longer rename anything on disk
+	folderIDs = {folder["id"]: folder for folder in folders}
+	depths = {}
+
+	for folder in folders:
+		chain = []
+		id = folder["id"]
+
+		while id in folderIDs and id not in depths and id not in chain:
+			chain.append(id)
+			parents = folderIDs[id].get("parents")
+			id = parents[0] if parents else None
+
+		depth = depths.get(id, -1)
+
+		for id in reversed(chain):
+			depth += 1
+			depths[id] = depth
+
+	return sorted(folders, key=lambda folder: depths[folder["id"]])
@@ -0,0 +1,182 @@
+import threading
+
+DIRECTORY_COLUMNS = (
+	"drive_id",
+	"root_folder_id",
+	"parent_folder_id",
+	"folder_id",
+	"local_path",
+	"remote_name",
+)
+
+
+class DirectoryIndex:
+	# In-memory view of one drive's directories and root folders for the duration of a sync pass.
+	# Lookups by folder ID and path are dictionary hits; writes go through to the SyncCacheManager
+	# and any other attribute is delegated to it, so the index can be passed wherever a cache is expected.
+
+	def __init__(self, cache, driveID):
+		self.cache = cache
+		self.driveID = driveID
+		self.lock = threading.RLock()
+		self.directories = {}
+		self.children = {}
+		self.paths = {}
+		self.folders = {folder["folder_id"]: folder for folder in cache.getFolders({"drive_id": driveID})}
+
+		for directory in cache.getDirectories({"drive_id": driveID}):
+			self._add(directory)
+
+	def __getattr__(self, name):
+		return getattr(self.cache, name)
+
+	def addDirectories(self, values):
+		self.cache.addDirectories(values)
+
+		with self.lock:
+
+			for value in values:
+				self._add(dict(zip(DIRECTORY_COLUMNS, value)))
+
+	def addDirectory(self, data):
+		self.cache.addDirectory(data)
+
+		with self.lock:
+			self._add(dict(data))
+
+	def deleteDirectory(self, value, column="folder_id"):
+		self.cache.deleteDirectory(value, column)
+
+		with self.lock:
+			values = set(value) if isinstance(value, (list, tuple, set)) else {value}
+
+			for directory in [d for d in self.directories.values() if d.get(column) in values]:
+				self._remove(directory["folder_id"])
+
+	def getDirectory(self, condition):
+
+		if condition.keys() != {"folder_id"}:
+			return self.cache.getDirectory(condition)
+
+		directory = self.directories.get(condition["folder_id"])
+		if directory: return dict(directory)
+
+	def getFolder(self, condition):
+
+		if condition.keys() != {"folder_id"}:
+			return self.cache.getFolder(condition)
+
+		folder = self.folders.get(condition["folder_id"])
+		if folder: return dict(folder)
+
+	def getUniqueDirectoryPath(self, driveID, path, folderID=None, paths=set()):
+		path_ = path
+		copy = 1
+
+		while True:
+			cachedFolderID = self.paths.get(path.lower())
+
+			if not cachedFolderID or folderID == cachedFolderID:
+				break
+
+			path = f"{path_} ({copy})"
+			copy += 1
+
+			if paths:
+				paths.add(path.lower())
+
+		return path
+
+	def removeDirectory(self, syncRootPath, drivePath, folderID):
+		deletedIDs = self.cache.removeDirectory(syncRootPath, drivePath, folderID)
+
+		with self.lock:
+
+			for id in deletedIDs:
+
+				if id in self.directories:
+					self._remove(id)
+
+	def removeEmptyDirectories(self, folderID):
+		deletedIDs = self.cache.removeEmptyDirectories(folderID)
+
+		with self.lock:
+
+			for id in deletedIDs:
+
+				if id in self.directories:
+					self._remove(id)
+
+	def updateChildPaths(self, oldPath, newPath, folderID):
+		self.cache.updateChildPaths(oldPath, newPath, folderID)
+
+		with self.lock:
+
+			for id in self._getSubtree(folderID):
+				path = self.directories[id]["local_path"]
+
+				if path.startswith(oldPath):
+					self._update(id, {"local_path": newPath + path[len(oldPath):]})
+
+	def updateDirectory(self, data, folderID):
+		self.cache.updateDirectory(data, folderID)
+
+		with self.lock:
+
+			if folderID in self.directories:
+				self._update(folderID, data)
+
+	def updateFolder(self, data, folderID):
+		self.cache.updateFolder(data, folderID)
+
+		with self.lock:
+
+			if folderID in self.folders:
+				self.folders[folderID].update(data)
+
+	def _add(self, directory):
+		folderID = directory["folder_id"]
+
+		if folderID in self.directories:
+			self._remove(folderID)
+
+		self.directories[folderID] = directory
+		self.children.setdefault(directory.get("parent_folder_id"), set()).add(folderID)
+
+		if directory.get("local_path"):
+			self.paths.setdefault(directory["local_path"].lower(), folderID)
+
+	def _getSubtree(self, folderID):
+
+		if folderID not in self.directories:
+			return []
+
+		subtree, pending = set(), [folderID]
+
+		while pending:
+			id = pending.pop()
+
+			if id in subtree:
+				continue
+
+			subtree.add(id)
+			pending += self.children.get(id, ())
+
+		return subtree
+
+	def _remove(self, folderID):
+		directory = self.directories.pop(folderID)
+		siblings = self.children.get(directory.get("parent_folder_id"))
+
+		if siblings:
+			siblings.discard(folderID)
+
+		path = (directory.get("local_path") or "").lower()
+
+		if self.paths.get(path) == folderID:
+			del self.paths[path]
+
+	def _update(self, folderID, data):
+		directory = dict(self.directories[folderID])
+		directory.update(data)
+		self._add(directory)
@@ -0,0 +1,61 @@
+import os
+import threading
+import contextlib
+
+
+class DriveScheduler:
+	# Different drives sync at the same time up to maxConcurrent. A drive's own passes stay serial
+	# and two drives whose local paths overlap never run together.
+
+	def __init__(self, maxConcurrent=1):
+		self.maxConcurrent = maxConcurrent
+		self.running = {}
+		self.driveLocks = {}
+		self.condition = threading.Condition()
+
+	def setMaxConcurrent(self, maxConcurrent):
+
+		with self.condition:
+			self.maxConcurrent = max(1, maxConcurrent)
+			self.condition.notify_all()
+
+	@contextlib.contextmanager
+	def slot(self, driveID, paths):
+		paths = [self._normalizePath(path) for path in paths]
+
+		with self._getDriveLock(driveID):
+
+			with self.condition:
+				self.condition.wait_for(lambda: len(self.running) < self.maxConcurrent and not self._overlaps(paths))
+				self.running[driveID] = paths
+
+			try:
+				yield
+			finally:
+
+				with self.condition:
+					del self.running[driveID]
+					self.condition.notify_all()
+
+	def _getDriveLock(self, driveID):
+
+		with self.condition:
+			lock = self.driveLocks.get(driveID)
+
+			if not lock:
+				lock = self.driveLocks[driveID] = threading.Lock()
+
+			return lock
+
+	def _overlaps(self, paths):
+		# a path overlaps another when it's the same directory or one contains the other
+		return any(
+			path.startswith(runningPath) or runningPath.startswith(path)
+			for runningPaths in self.running.values()
+			for runningPath in runningPaths
+			for path in paths
+		)
+
+	@staticmethod
+	def _normalizePath(path):
+		return os.path.join(os.path.normcase(os.path.abspath(path)), "")
@@ -0,0 +1,36 @@
+import threading
+import collections
+
+
+class IDRegistry:
+	# IDs handled during one change sync pass, shared by the syncer and the file trees of the folders it adds.
+	# Every ID is stored once together with the reason it was processed, which doubles as the pass' stats.
+
+	def __init__(self):
+		self.ids = {}
+		self.lock = threading.Lock()
+
+	def __contains__(self, id):
+		return id in self.ids
+
+	def __len__(self):
+		return len(self.ids)
+
+	def add(self, id, reason):
+		# returns False if the ID was already processed > the first reason is kept
+
+		with self.lock:
+
+			if id in self.ids:
+				return False
+
+			self.ids[id] = reason
+			return True
+
+	def getReason(self, id):
+		return self.ids.get(id)
+
+	def getStats(self):
+
+		with self.lock:
+			return dict(collections.Counter(self.ids.values()))
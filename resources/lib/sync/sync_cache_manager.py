@@ -9,18 +9,134 @@ if not os.path.exists(ADDON_PATH):
 	os.mkdir(ADDON_PATH)
 
 CACHE_PATH = os.path.join(ADDON_PATH, "sync_cache.db")
+SCHEMA_VERSION = 2
+TABLES = {
+	"global": (
+		"local_path TEXT",
+		"operating_system TEXT",
+	),
+	"drives": (
+		"drive_id TEXT PRIMARY KEY",
+		"local_path TEXT",
+		"page_token INTEGER",
+		"last_update REAL",
+		"task_mode TEXT",
+		"task_frequency TEXT",
+		"startup_sync INTEGER",
+	),
+	"folders": (
+		"drive_id TEXT",
+		"folder_id TEXT PRIMARY KEY",
+		"local_path TEXT",
+		"remote_name TEXT",
+		"file_renaming INTEGER",
+		"folder_renaming INTEGER",
+		"contains_encrypted INTEGER",
+		"sync_nfo INTEGER",
+		"sync_subtitles INTEGER",
+		"sync_artwork INTEGER",
+		"sync_strm INTEGER",
+		"strm_prefix TEXT",
+		"strm_suffix TEXT",
+		"tmdb_language TEXT",
+		"tmdb_region TEXT",
+		"tmdb_adult TEXT",
+	),
+	"directories": (
+		"drive_id TEXT",
+		"root_folder_id TEXT",
+		"parent_folder_id TEXT",
+		"folder_id TEXT PRIMARY KEY",
+		"local_path TEXT",
+		"remote_name TEXT",
+	),
+	"files": (
+		"drive_id TEXT",
+		"root_folder_id TEXT",
+		"parent_folder_id TEXT",
+		"file_id TEXT PRIMARY KEY",
+		"local_path TEXT",
+		"local_name TEXT",
+		"remote_name TEXT",
+		"original_name INTEGER",
+		"original_folder INTEGER",
+		"has_metadata INTEGER",
+		"modified_time INTEGER",
+	),
+	# changes of the page being synced that are already applied > skipped when an interrupted pass replays the page
+	"change_journal": (
+		"drive_id TEXT",
+		"file_id TEXT",
+		"change_time TEXT",
+	),
+}
+INDEXES = {
+	"folders_drive_path": ("folders", "drive_id, local_path COLLATE NOCASE"),
+	"directories_parent": ("directories", "parent_folder_id"),
+	"directories_root": ("directories", "root_folder_id"),
+	# covers getUniqueDirectoryPath's case-insensitive path lookup without touching the table
+	"directories_drive_path": ("directories", "drive_id, local_path COLLATE NOCASE, folder_id"),
+	"files_parent": ("files", "parent_folder_id"),
+	"files_root": ("files", "root_folder_id"),
+	"files_drive": ("files", "drive_id"),
+}
+
+# every directory below (and including) the bound folder ID > UNION also stops on root folders that list themselves as parent
+SUBTREE = """WITH RECURSIVE subtree(folder_id) AS (
+	SELECT folder_id FROM directories WHERE folder_id = ?
+	UNION
+	SELECT directories.folder_id FROM directories JOIN subtree ON directories.parent_folder_id = subtree.folder_id
+)"""
+
+
+def _rebuildTable(table):
+	# sqlite can't add a primary key to an existing table > copy the rows into a new one, keeping the latest duplicate
+	columns = TABLES[table]
+	names = ", ".join(column.split()[0] for column in columns)
+	return (
+		f"CREATE TABLE {table}_migration ({', '.join(columns)})",
+		f"INSERT OR REPLACE INTO {table}_migration ({names}) SELECT {names} FROM {table} ORDER BY rowid",
+		f"DROP TABLE {table}",
+		f"ALTER TABLE {table}_migration RENAME TO {table}",
+	)
+
+
+MIGRATIONS = (
+	(
+		1,
+		(
+			*_rebuildTable("drives"),
+			*_rebuildTable("folders"),
+			*_rebuildTable("directories"),
+			*_rebuildTable("files"),
+			*(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})" for name, (table, columns) in INDEXES.items()),
+		),
+	),
+	(
+		2,
+		(
+			f"CREATE TABLE IF NOT EXISTS change_journal ({', '.join(TABLES['change_journal'])})",
+		),
+	),
+)
 
 
 class SyncCacheManager(DatabaseManager):
 
 	def __init__(self):
 		newDB = not os.path.exists(CACHE_PATH)
-		super().__init__(CACHE_PATH)
+		super().__init__(CACHE_PATH, walMode=True)
 		self.settings = SETTINGS
 		self.fileOperations = FileOperations()
 
 		if newDB:
 			self.createTables()
+		else:
+			self.migrate(MIGRATIONS)
+
+	def addChanges(self, driveID, items):
+		values = [(driveID, item["id"], item.get("changeTime")) for item in items]
+		self.insertMany("change_journal", ("drive_id", "file_id", "change_time"), values)
 
 	def addDirectories(self, values):
 		columns = (
@@ -31,16 +147,16 @@ class SyncCacheManager(DatabaseManager):
 			"local_path",
 			"remote_name",
 		)
-		self.insertMany("directories", columns, values)
+		self.insertMany("directories", columns, values, replace=True)
 
 	def addDirectory(self, data):
-		self.insert("directories", data)
+		self.insert("directories", data, replace=True)
 
 	def addDrive(self, data):
-		self.insert("drives", data)
+		self.insert("drives", data, replace=True)
 
 	def addFile(self, data):
-		self.insert("files", data)
+		self.insert("files", data, replace=True)
 
 	def addFiles(self, values):
 		columns = (
@@ -56,10 +172,10 @@ class SyncCacheManager(DatabaseManager):
 			"has_metadata",
 			"modified_time",
 		)
-		self.insertMany("files", columns, values)
+		self.insertMany("files", columns, values, replace=True)
 
 	def addFolder(self, data):
-		self.insert("folders", data)
+		self.insert("folders", data, replace=True)
 
 	def addFolders(self, values):
 		columns = (
@@ -80,22 +196,29 @@ class SyncCacheManager(DatabaseManager):
 			"tmdb_region",
 			"tmdb_adult",
 		)
-		self.insertMany("folders", columns, values)
+		self.insertMany("folders", columns, values, replace=True)
 
 	def addGlobalData(self, data):
 		self.insert("global", data)
 
 	def cleanCache(self, driveID):
+		self.clearChanges(driveID)
 		self.deleteFile(driveID, column="drive_id")
 		self.deleteDirectory(driveID, column="drive_id")
 		self.deleteFolder(driveID, column="drive_id")
 
+	def clearChanges(self, driveID):
+		self.delete("change_journal", {"drive_id": driveID})
+
 	def createTables(self):
-		self._createGlobalTable()
-		self._createDriveTable()
-		self._createFoldersTable()
-		self._createDirectoriesTable()
-		self._createFilesTable()
+
+		for table, columns in TABLES.items():
+			self.createTable(table, columns)
+
+		for name, (table, columns) in INDEXES.items():
+			self.createIndex(name, table, columns)
+
+		self.setVersion(SCHEMA_VERSION)
 
 	def deleteDirectory(self, value, column="folder_id"):
 		self.delete("directories", {column: value})
@@ -115,6 +238,9 @@ class SyncCacheManager(DatabaseManager):
 	def deleteFolder(self, value, column="folder_id"):
 		self.delete("folders", {column: value})
 
+	def getChanges(self, driveID):
+		return {(change["file_id"], change["change_time"]) for change in self.selectAll("change_journal", {"drive_id": driveID})}
+
 	def getDirectories(self, condition):
 		return self.selectAll("directories", condition)
 
@@ -146,6 +272,9 @@ class SyncCacheManager(DatabaseManager):
 	def getFolders(self, condition):
 		return self.selectAll("folders", condition)
 
+	def getSubtree(self, folderID):
+		return self.query(f"{SUBTREE} SELECT * FROM directories WHERE folder_id IN subtree", (folderID,))
+
 	def getSyncRootPath(self):
 		return self.select("global", "local_path")
 
@@ -183,54 +312,54 @@ class SyncCacheManager(DatabaseManager):
 	def removeDirectories(self, syncRootPath, drivePath, rootFolderID, deleteFiles, progressDialog):
 
 		if deleteFiles:
-			directories = self.getDirectories({"root_folder_id": rootFolderID})
-
-			for directory in directories:
-				folderID = directory["folder_id"]
-				files = self.getFiles({"parent_folder_id": folderID})
+			directories = {directory["folder_id"]: directory for directory in self.getDirectories({"root_folder_id": rootFolderID})}
+			files = self.getFiles({"parent_folder_id": list(directories)})
 
-				for file in files:
+			for file in files:
+				directory = directories[file["parent_folder_id"]]
 
-					if file["original_folder"]:
-						filename = file["local_name"]
-						filePath = os.path.join(drivePath, directory["local_path"], filename)
-					else:
-						filePath = os.path.join(syncRootPath, file["local_path"])
-						filename = os.path.basename(filePath)
+				if file["original_folder"]:
+					filename = file["local_name"]
+					filePath = os.path.join(drivePath, directory["local_path"], filename)
+				else:
+					filePath = os.path.join(syncRootPath, file["local_path"])
+					filename = os.path.basename(filePath)
 
-					self.fileOperations.deleteFile(syncRootPath, filePath=filePath)
+				self.fileOperations.deleteFile(syncRootPath, filePath=filePath)
 
-					if progressDialog:
-						progressDialog.processed += 1
-						progressDialog.update(filename)
+				if progressDialog:
+					progressDialog.processed += 1
+					progressDialog.update(filename)
 
-		self.deleteFile(rootFolderID, column="root_folder_id")
-		self.deleteDirectory(rootFolderID, column="root_folder_id")
+		with self.transaction():
+			self.deleteFile(rootFolderID, column="root_folder_id")
+			self.deleteDirectory(rootFolderID, column="root_folder_id")
 
 	def removeDirectory(self, syncRootPath, drivePath, folderID):
-		directories = self.getDirectories({"folder_id": folderID})
+		directories = {directory["folder_id"]: directory for directory in self.getSubtree(folderID) or []}
+		files = self.query(f"{SUBTREE} SELECT * FROM files WHERE parent_folder_id IN subtree", (folderID,)) or []
 
-		while directories:
-			directory = directories.pop()
-			folderID = directory["folder_id"]
-			files = self.getFiles({"parent_folder_id": folderID})
+		for file in files:
 
-			for file in files:
-
-				if file["original_folder"]:
-					filePath = os.path.join(drivePath, directory["local_path"], file["local_name"])
-				else:
-					filePath = os.path.join(syncRootPath, file["local_path"])
+			if file["original_folder"]:
+				filePath = os.path.join(drivePath, directories[file["parent_folder_id"]]["local_path"], file["local_name"])
+			else:
+				filePath = os.path.join(syncRootPath, file["local_path"])
 
-				self.fileOperations.deleteFile(syncRootPath, filePath=filePath)
+			self.fileOperations.deleteFile(syncRootPath, filePath=filePath)
 
-			self.deleteFile(folderID, column="parent_folder_id")
-			self.deleteDirectory(folderID)
-			directories += self.getDirectories({"parent_folder_id": folderID})
+		self.execute(
+			(
+				(f"{SUBTREE} DELETE FROM files WHERE parent_folder_id IN subtree", (folderID,)),
+				(f"{SUBTREE} DELETE FROM directories WHERE folder_id IN subtree", (folderID,)),
+			)
+		)
+		return list(directories)
 
 	def removeEmptyDirectories(self, folderID):
 		directories = self.getDirectories({"root_folder_id": folderID})
 		directories = sorted([(dir["local_path"], dir["folder_id"]) for dir in directories], key=lambda x: x[0])
+		leafIDs = []
 
 		for idx, (dirPath, folderID) in enumerate(directories):
 
@@ -240,10 +369,18 @@ class SyncCacheManager(DatabaseManager):
 					break
 
 			else:
-				files = self.getFiles({"parent_folder_id": folderID})
+				leafIDs.append(folderID)
 
-				if not files:
-					self.deleteDirectory(folderID)
+		if not leafIDs:
+			return []
+
+		nonEmptyIDs = {file["parent_folder_id"] for file in self.getFiles({"parent_folder_id": leafIDs})}
+		emptyIDs = [folderID for folderID in leafIDs if folderID not in nonEmptyIDs]
+
+		if emptyIDs:
+			self.deleteDirectory(emptyIDs)
+
+		return emptyIDs
 
 	def removeFolder(self, folderID, deleteFiles=False):
 		folder = self.getFolder({"folder_id": folderID})
@@ -294,20 +431,14 @@ class SyncCacheManager(DatabaseManager):
 		self.insert("global", {"local_path": path})
 
 	def updateChildPaths(self, oldPath, newPath, folderID):
-		directories = self.getDirectories({"folder_id": folderID})
-		processedIDs = set()
-
-		while directories:
-			directory = directories.pop()
-			folderID = directory["folder_id"]
-			directory["local_path"] = directory["local_path"].replace(oldPath, newPath, 1)
-			self.updateDirectory(directory, folderID)
-
-			if folderID in processedIDs:
-				continue
-
-			processedIDs.add(folderID)
-			directories += self.getDirectories({"parent_folder_id": folderID})
+		self.execute(
+			(
+				(
+					f"{SUBTREE} UPDATE directories SET local_path = ? || substr(local_path, ?) WHERE folder_id IN subtree AND substr(local_path, 1, ?) = ?",
+					(folderID, newPath, len(oldPath) + 1, len(oldPath), oldPath),
+				),
+			)
+		)
 
 	def updateDirectory(self, data, folderID):
 		self.update("directories", data, {"folder_id": folderID})
@@ -323,70 +454,3 @@ class SyncCacheManager(DatabaseManager):
 
 	def updateSyncRootPath(self, path):
 		self.update("global", {"local_path": path})
-
-	def _createDirectoriesTable(self):
-		columns = (
-			"drive_id TEXT",
-			"root_folder_id TEXT",
-			"parent_folder_id TEXT",
-			"folder_id TEXT",
-			"local_path TEXT",
-			"remote_name TEXT",
-		)
-		self.createTable("directories", columns)
-
-	def _createDriveTable(self):
-		columns = (
-			"drive_id TEXT",
-			"local_path TEXT",
-			"page_token INTEGER",
-			"last_update REAL",
-			"task_mode TEXT",
-			"task_frequency TEXT",
-			"startup_sync INTEGER",
-		)
-		self.createTable("drives", columns)
-
-	def _createFilesTable(self):
-		columns = (
-			"drive_id TEXT",
-			"root_folder_id TEXT",
-			"parent_folder_id TEXT",
-			"file_id TEXT",
-			"local_path TEXT",
-			"local_name TEXT",
-			"remote_name TEXT",
-			"original_name INTEGER",
-			"original_folder INTEGER",
-			"has_metadata INTEGER",
-			"modified_time INTEGER",
-		)
-		self.createTable("files", columns)
-
-	def _createFoldersTable(self):
-		columns = (
-			"drive_id TEXT",
-			"folder_id TEXT",
-			"local_path TEXT",
-			"remote_name TEXT",
-			"file_renaming INTEGER",
-			"folder_renaming INTEGER",
-			"contains_encrypted INTEGER",
-			"sync_nfo INTEGER",
-			"sync_subtitles INTEGER",
-			"sync_artwork INTEGER",
-			"sync_strm INTEGER",
-			"strm_prefix TEXT",
-			"strm_suffix TEXT",
-			"tmdb_language TEXT",
-			"tmdb_region TEXT",
-			"tmdb_adult TEXT",
-		)
-		self.createTable("folders", columns)
-
-	def _createGlobalTable(self):
-		columns = (
-			"local_path TEXT",
-			"operating_system TEXT",
-		)
-		self.createTable("global", columns)
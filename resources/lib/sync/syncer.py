@@ -2,6 +2,9 @@ import os
 
 import xbmc
 
+from .id_registry import IDRegistry
+from .directory_index import DirectoryIndex
+from .change_coalescer import coalesceChanges, sortByDepth
 from .sync_cache_updater import SyncCacheUpdater
 from ..filesystem.folder import Folder
 from ..filesystem.file_tree import FileTree
@@ -9,7 +12,8 @@ from ..filesystem.file_maker import makeFile
 from ..filesystem.fs_constants import MEDIA_ASSETS
 from ..filesystem.fs_helpers import getExcludedTypes, removeProhibitedFSchars
 from ..filesystem.file_processor import LocalFileProcessor, RemoteFileProcessor
-from ..threadpool.threadpool import ThreadPool
+from ..threadpool.threadpool import PRIORITY_LOW, ThreadPool
+from ..google_api.async_google_drive import AsyncGoogleDrive
 from helpers import sendJSONRPCCommand
 
 
@@ -22,6 +26,8 @@ class Syncer:
 		self.fileOperations = fileOperations
 		self.settings = settings
 		self.cache = cache
+		self.asyncCloudService = None
+		self.monitor = xbmc.Monitor()
 
 	def syncChanges(self, driveID):
 		account = self.accountManager.setAccounts()
@@ -35,47 +41,46 @@ class Syncer:
 		driveSettings = self.cache.getDrive(driveID)
 		syncRootPath = self.cache.getSyncRootPath()
 		drivePath = os.path.join(syncRootPath, driveSettings["local_path"])
-		changes, pageToken = self.cloudService.getChanges(driveSettings["page_token"])
+		driveClient = self._getDriveClient()
 
-		if not pageToken:
-			return
+		if driveClient is self.cloudService:
+			pages = self.cloudService.getChangePages(driveSettings["page_token"])
+		else:
+			pages = driveClient.iterate(driveClient.getChangePages(driveSettings["page_token"]))
 
-		if not changes:
-			return True
+		self.index = DirectoryIndex(self.cache, driveID)
+		self.cloudService.clearParentCache()
+		self.added = self.deleted = False
+		syncedIDs = IDRegistry()
+		completed = False
 
-		changes = self._sortChanges(changes)
-		self.deleted = False
-		syncedIDs = []
-		newFiles = {}
+		# changes are processed page by page > only one page is held in memory and the page token is checkpointed
+		# after every page, so an interrupted pass resumes where it stopped instead of fetching everything again.
+		# within a page every applied change is journaled, so replaying the page skips what's already on disk
+		for changes, nextPageToken, newStartPageToken in pages:
+			pageToken = nextPageToken or newStartPageToken
 
-		for item in changes:
-			id = item["id"]
+			if not pageToken:
+				break
 
-			if id in syncedIDs:
-				continue
+			with self.cache.transaction():
 
-			syncedIDs.append(id)
+				if changes and not self._syncChangePage(changes, driveID, syncRootPath, drivePath, syncedIDs):
+					break
 
-			try:
-				# shared items that google automatically adds to an account don't have parentFolderIDs
-				parentFolderID = item["parents"][0]
-			except KeyError:
-				continue
+				# the checkpoint and the end of the page's journal are committed together
+				self.cache.updateDrive({"page_token": pageToken}, driveID)
+				self.cache.clearChanges(driveID)
 
-			if item["trashed"]:
-				self._syncDeletions(item, syncRootPath, drivePath)
-				continue
+			completed = bool(newStartPageToken)
 
-			if item["mimeType"] == "application/vnd.google-apps.folder":
-				self._syncFolderChanges(item, parentFolderID, driveID, syncRootPath, drivePath, syncedIDs)
-			else:
-				self._syncFileChanges(item, parentFolderID, driveID, syncRootPath, drivePath, newFiles)
+		self.cloudService.clearParentCache()
+		self.index = None
+		xbmc.log(f"gdrive: changes synced for drive {driveID}: {syncedIDs.getStats()}", xbmc.LOGDEBUG)
 
-		if newFiles:
-			self._syncFileAdditions(newFiles, syncRootPath)
-
-			if self.settings.getSetting("update_library"):
-				xbmc.executebuiltin(f"UpdateLibrary(video,{syncRootPath})")
+		# renames and deletions don't need a scan > only new files do
+		if self.added and self.settings.getSetting("update_library"):
+			xbmc.executebuiltin(f"UpdateLibrary(video,{syncRootPath})")
 
 		if self.deleted and self.settings.getSetting("update_library"):
 
@@ -90,10 +95,11 @@ class Syncer:
 			}
 			sendJSONRPCCommand(query)
 
-		self.cache.updateDrive({"page_token": pageToken}, driveID)
-		return True
+		if completed:
+			return True
 
-	def syncFolderAdditions(self, syncRootPath, drivePath, folder, folderSettings, progressDialog=None, syncedIDs=None):
+	def syncFolderAdditions(self, syncRootPath, drivePath, folder, folderSettings, progressDialog=None, syncedIDs=None, cache=None):
+		cache = cache or self.cache
 		syncRootPath = syncRootPath + os.sep
 		excludedTypes = getExcludedTypes(folderSettings)
 		driveID = folderSettings["drive_id"]
@@ -101,24 +107,26 @@ class Syncer:
 		fileRenaming = folderSettings["file_renaming"]
 		prefix = [p for p in folderSettings["strm_prefix"].split(", ") if p]
 		suffix = [s for s in folderSettings["strm_suffix"].split(", ") if s]
-		threadCount = self.settings.getSettingInt("thread_count", 1)
 		encryptor = self.encryptor if folderSettings["contains_encrypted"] else None
-		cacheUpdater = SyncCacheUpdater(self.cache)
+		cacheUpdater = SyncCacheUpdater(cache)
 
-		with RemoteFileProcessor(self.fileOperations, cacheUpdater, threadCount, progressDialog) as fileProcessor:
-			fileTree = FileTree(fileProcessor, self.cloudService, self.cache, cacheUpdater, driveID, syncRootPath, drivePath, folderRenaming, fileRenaming, threadCount, encryptor, prefix, suffix, excludedTypes, syncedIDs)
+		with RemoteFileProcessor(self.fileOperations, cacheUpdater, progressDialog) as fileProcessor:
+			fileTree = FileTree(fileProcessor, self._getDriveClient(), cache, cacheUpdater, driveID, syncRootPath, drivePath, folderRenaming, fileRenaming, encryptor, prefix, suffix, excludedTypes, syncedIDs)
 			fileTree.buildTree(folder)
 
+		# the renaming workers run on other threads and have to see the rows added above
+		cache.flush()
+
 		if progressDialog:
 			progressDialog.processFolder()
 
 		if folderRenaming or fileRenaming:
 			localFileProcessor = LocalFileProcessor(self.fileOperations, self.cache, syncRootPath, progressDialog)
 
-			with ThreadPool(threadCount) as pool:
+			with ThreadPool(PRIORITY_LOW) as pool:
 
 				for folder in fileTree:
-					pool.submit(localFileProcessor.processFiles, folder, folderSettings, threadCount)
+					pool.submit(localFileProcessor.processFiles, folder, folderSettings)
 
 		for folder in fileTree:
 			modifiedTime = folder.modifiedTime
@@ -128,16 +136,69 @@ class Syncer:
 			except os.error:
 				continue
 
+	def _syncChangePage(self, changes, driveID, syncRootPath, drivePath, syncedIDs):
+		# returns False when kodi is shutting down > the page is replayed from its journal next time
+		changes = self._sortChanges(changes, self.cache.getChanges(driveID))
+		self._resolveParents(changes)
+		fileChanges = []
+		newFiles = {}
+
+		for item in changes:
+
+			if self.monitor.abortRequested():
+				return False
+
+			id = item["id"]
+
+			# changes are coalesced, so a repeat ID is a newer state from a later page > only the items that were
+			# listed while crawling a new folder are current already
+			if syncedIDs.getReason(id) == "crawled":
+				continue
+
+			try:
+				# shared items that google automatically adds to an account don't have parentFolderIDs
+				parentFolderID = item["parents"][0]
+			except KeyError:
+				syncedIDs.add(id, "unparented")
+				continue
+
+			if item["trashed"]:
+				syncedIDs.add(id, "trashed")
+				self._syncDeletions(item, syncRootPath, drivePath)
+				self.cache.addChanges(driveID, [item])
+				# the deletion is on disk already > its rows are committed so a failure later in the page can't drop them
+				self.cache.flush()
+			elif item["mimeType"] == "application/vnd.google-apps.folder":
+				syncedIDs.add(id, "folder")
+				self._syncFolderChanges(item, parentFolderID, driveID, syncRootPath, drivePath, syncedIDs)
+				self.cache.addChanges(driveID, [item])
+				# a folder can pull in a whole tree > commit it right away so it's never synced twice
+				self.cache.flush()
+			else:
+				syncedIDs.add(id, "file")
+				self._syncFileChanges(item, parentFolderID, driveID, syncRootPath, drivePath, newFiles)
+				fileChanges.append(item)
+				# same for renames and the deletes before a redownload > a change that only queued a new file has
+				# nothing buffered, so this doesn't commit per file
+				self.cache.flush()
+
+		if newFiles:
+			self._syncFileAdditions(newFiles, syncRootPath)
+			self.added = True
+
+		# new files are only on disk once the additions are done
+		self.cache.addChanges(driveID, fileChanges)
+		return True
+
 	def _syncFileAdditions(self, files, syncRootPath):
 		syncRootPath = syncRootPath + os.sep
-		threadCount = self.settings.getSettingInt("thread_count", 1)
 		cacheUpdater = SyncCacheUpdater(self.cache)
 		folders = []
 
-		with RemoteFileProcessor(self.fileOperations, cacheUpdater, threadCount) as fileProcessor:
+		with RemoteFileProcessor(self.fileOperations, cacheUpdater) as fileProcessor:
 
 			for rootFolderID, directories in files.items():
-				folderSettings = self.cache.getFolder({"folder_id": rootFolderID})
+				folderSettings = self.index.getFolder({"folder_id": rootFolderID})
 				folderRenaming = folderSettings["folder_renaming"]
 				fileRenaming = folderSettings["file_renaming"]
 
@@ -151,11 +212,13 @@ class Syncer:
 					if folderRenaming or fileRenaming:
 						folders.append((folder, folderSettings))
 
-		with ThreadPool(threadCount) as pool:
+		self.cache.flush()
+
+		with ThreadPool(PRIORITY_LOW) as pool:
 			localFileProcessor = LocalFileProcessor(self.fileOperations, self.cache, syncRootPath)
 
 			for folder, folderSettings in folders:
-				pool.submit(localFileProcessor.processFiles, folder, folderSettings, threadCount)
+				pool.submit(localFileProcessor.processFiles, folder, folderSettings)
 
 	def _syncDeletions(self, item, syncRootPath, drivePath):
 		id = item["id"]
@@ -172,7 +235,7 @@ class Syncer:
 
 			self.cache.deleteFile(id)
 			folderID = cachedFile["parent_folder_id"]
-			cachedDirectory = self.cache.getDirectory({"folder_id": folderID})
+			cachedDirectory = self.index.getDirectory({"folder_id": folderID})
 			cachedFiles = self.cache.getFile({"parent_folder_id": folderID})
 
 			if cachedFile["original_folder"]:
@@ -183,18 +246,18 @@ class Syncer:
 				self.fileOperations.deleteFile(syncRootPath, filePath=filePath)
 
 		if not cachedFiles:
-			cachedDirectory = self.cache.getDirectory({"folder_id": folderID})
+			cachedDirectory = self.index.getDirectory({"folder_id": folderID})
 
 			if not cachedDirectory:
 				return
 
-			self.cache.removeEmptyDirectories(cachedDirectory["root_folder_id"])
+			self.index.removeEmptyDirectories(cachedDirectory["root_folder_id"])
 
 		self.deleted = True
 
 	def _syncFileChanges(self, file, parentFolderID, driveID, syncRootPath, drivePath, newFiles):
 		fileID = file["id"]
-		cachedDirectory = self.cache.getDirectory({"folder_id": parentFolderID})
+		cachedDirectory = self.index.getDirectory({"folder_id": parentFolderID})
 		cachedFile = self.cache.getFile({"file_id": fileID})
 
 		if cachedDirectory:
@@ -202,12 +265,12 @@ class Syncer:
 			cachedParentFolderID = cachedDirectory["parent_folder_id"]
 			rootFolderID = cachedDirectory["root_folder_id"]
 		else:
-			dirPath, rootFolderID = self.cloudService.getDirectory(self.cache, parentFolderID)
+			dirPath, rootFolderID = self.cloudService.getDirectory(self.index, parentFolderID)
 
 			if not rootFolderID and cachedFile:
 				# file has moved outside of root folder hierarchy/tree > delete file
 				cachedParentFolderID = cachedFile["parent_folder_id"]
-				cachedDirectory = self.cache.getDirectory({"folder_id": cachedParentFolderID})
+				cachedDirectory = self.index.getDirectory({"folder_id": cachedParentFolderID})
 
 				if cachedFile["original_folder"]:
 					cachedFilePath = os.path.join(drivePath, cachedDirectory["local_path"], cachedFile["local_name"])
@@ -223,7 +286,7 @@ class Syncer:
 				return
 
 			folderName = os.path.basename(dirPath)
-			dirPath = self.cache.getUniqueDirectoryPath(driveID, dirPath)
+			dirPath = self.index.getUniqueDirectoryPath(driveID, dirPath)
 			parentsParentFolderID = self.cloudService.getParentDirectoryID(parentFolderID)
 			directory = {
 				"drive_id": driveID,
@@ -233,9 +296,9 @@ class Syncer:
 				"parent_folder_id": parentsParentFolderID if parentsParentFolderID != driveID else parentFolderID,
 				"root_folder_id": rootFolderID,
 			}
-			self.cache.addDirectory(directory)
+			self.index.addDirectory(directory)
 
-		folderSettings = self.cache.getFolder({"folder_id": rootFolderID})
+		folderSettings = self.index.getFolder({"folder_id": rootFolderID})
 		excludedTypes = getExcludedTypes(folderSettings)
 		folderRenaming = folderSettings["folder_renaming"]
 		prefix = [p for p in folderSettings["strm_prefix"].split(", ") if p]
@@ -249,7 +312,7 @@ class Syncer:
 		filename = file.remoteName
 
 		if cachedFile:
-			cachedDirectory = self.cache.getDirectory({"folder_id": cachedFile["parent_folder_id"]})
+			cachedDirectory = self.index.getDirectory({"folder_id": cachedFile["parent_folder_id"]})
 			cachedDirPath = cachedDirectory["local_path"]
 			rootFolderID = cachedDirectory["root_folder_id"]
 
@@ -309,20 +372,21 @@ class Syncer:
 	def _syncFolderChanges(self, folder, parentFolderID, driveID, syncRootPath, drivePath, syncedIDs):
 		folderID = folder["id"]
 		folderName = folder["name"]
-		cachedDirectory = self.cache.getDirectory({"folder_id": folderID})
+		cachedDirectory = self.index.getDirectory({"folder_id": folderID})
 
 		if not cachedDirectory:
 			# new folder added
-			dirPath, rootFolderID = self.cloudService.getDirectory(self.cache, folderID)
+			dirPath, rootFolderID = self.cloudService.getDirectory(self.index, folderID)
 
 			if not rootFolderID:
 				return
 
-			folderSettings = self.cache.getFolder({"folder_id": rootFolderID})
+			folderSettings = self.index.getFolder({"folder_id": rootFolderID})
 			modifiedTime = folder["modifiedTime"]
-			dirPath = self.cache.getUniqueDirectoryPath(driveID, dirPath)
+			dirPath = self.index.getUniqueDirectoryPath(driveID, dirPath)
 			folder = Folder(folderID, parentFolderID, rootFolderID, driveID, folderName, dirPath, os.path.join(drivePath, dirPath), syncRootPath, folderSettings["folder_renaming"], modifiedTime=modifiedTime)
-			self.syncFolderAdditions(syncRootPath, drivePath, folder, folderSettings, syncedIDs=syncedIDs)
+			self.syncFolderAdditions(syncRootPath, drivePath, folder, folderSettings, syncedIDs=syncedIDs, cache=self.index)
+			self.added = True
 			return
 
 		# existing folder
@@ -333,24 +397,24 @@ class Syncer:
 
 		if parentFolderID != cachedParentFolderID and folderID != cachedRootFolderID:
 			# folder has been moved into another directory
-			dirPath, rootFolderID = self.cloudService.getDirectory(self.cache, folderID)
+			dirPath, rootFolderID = self.cloudService.getDirectory(self.index, folderID)
 
 			if not dirPath:
 				# folder has moved outside of root folder hierarchy/tree > delete folder
-				self.cache.removeDirectory(syncRootPath, drivePath, folderID)
+				self.index.removeDirectory(syncRootPath, drivePath, folderID)
 				self.deleted = True
 			else:
-				self.cache.updateDirectory({"parent_folder_id": parentFolderID}, folderID)
-				cachedParentDirectory = self.cache.getDirectory({"folder_id": parentFolderID})
+				self.index.updateDirectory({"parent_folder_id": parentFolderID}, folderID)
+				cachedParentDirectory = self.index.getDirectory({"folder_id": parentFolderID})
 
 				if cachedParentDirectory:
-					dirPath = self.cache.getUniqueDirectoryPath(driveID, dirPath)
+					dirPath = self.index.getUniqueDirectoryPath(driveID, dirPath)
 				else:
 					parentDirPath = os.path.split(dirPath)[0]
 					parentFolderName = os.path.basename(parentDirPath)
-					parentDirPath = self.cache.getUniqueDirectoryPath(driveID, parentDirPath)
+					parentDirPath = self.index.getUniqueDirectoryPath(driveID, parentDirPath)
 					dirPath = os.path.join(parentDirPath, folderName)
-					dirPath = self.cache.getUniqueDirectoryPath(driveID, dirPath)
+					dirPath = self.index.getUniqueDirectoryPath(driveID, dirPath)
 					parentsParentFolderID = self.cloudService.getParentDirectoryID(parentFolderID)
 					directory = {
 						"drive_id": driveID,
@@ -360,41 +424,88 @@ class Syncer:
 						"parent_folder_id": parentsParentFolderID if parentsParentFolderID != driveID else parentFolderID,
 						"root_folder_id": rootFolderID,
 					}
-					self.cache.addDirectory(directory)
+					self.index.addDirectory(directory)
 
 				oldPath = os.path.join(drivePath, cachedDirectoryPath)
 				newPath = os.path.join(drivePath, dirPath)
 				self.fileOperations.renameFolder(syncRootPath, oldPath, newPath)
-				self.cache.updateChildPaths(cachedDirectoryPath, dirPath, folderID)
+				self.index.updateChildPaths(cachedDirectoryPath, dirPath, folderID)
 
 		elif cachedRemoteName != folderName:
 			# folder renamed
 			cachedDirectoryPathHead, _ = os.path.split(cachedDirectoryPath)
 			newDirectoryPath = os.path.join(cachedDirectoryPathHead, folderName)
-			newDirectoryPath = self.cache.getUniqueDirectoryPath(driveID, newDirectoryPath, folderID)
+			newDirectoryPath = self.index.getUniqueDirectoryPath(driveID, newDirectoryPath, folderID)
 			oldPath = os.path.join(drivePath, cachedDirectoryPath)
 			newPath = os.path.join(drivePath, newDirectoryPath)
 			self.fileOperations.renameFolder(syncRootPath, oldPath, newPath)
-			self.cache.updateChildPaths(cachedDirectoryPath, newDirectoryPath, folderID)
-			self.cache.updateDirectory({"remote_name": folderName}, folderID)
+			self.index.updateChildPaths(cachedDirectoryPath, newDirectoryPath, folderID)
+			self.index.updateDirectory({"remote_name": folderName}, folderID)
 
 			if folderID == cachedRootFolderID:
-				self.cache.updateFolder({"local_path": newDirectoryPath, "remote_name": folderName}, folderID)
+				self.index.updateFolder({"local_path": newDirectoryPath, "remote_name": folderName}, folderID)
+
+	def _getDriveClient(self):
+		# listing and change requests go through the asyncio client when it's enabled
+
+		if not self.settings.getSetting("async_drive_client"):
+			return self.cloudService
+
+		if not self.asyncCloudService:
+			self.asyncCloudService = AsyncGoogleDrive(self.cloudService)
 
-	def _sortChanges(self, changes):
+		return self.asyncCloudService
+
+	def _resolveParents(self, changes):
+		# prefetch the ancestry of every new or moved folder and of every uncached file parent in a handful of batch requests
+		folders, folderIDs = [], set()
+
+		for item in changes:
+
+			if item["trashed"] or not item.get("parents"):
+				continue
+
+			parentFolderID = item["parents"][0]
+
+			if item["mimeType"] == "application/vnd.google-apps.folder":
+				cachedDirectory = self.index.getDirectory({"folder_id": item["id"]})
+
+				if not cachedDirectory or cachedDirectory["parent_folder_id"] != parentFolderID:
+					folders.append(item)
+
+			elif not self.index.getDirectory({"folder_id": parentFolderID}):
+				folderIDs.add(parentFolderID)
+
+		if folders or folderIDs:
+			self.cloudService.resolveParents(self.index, folderIDs, folders)
+
+	def _sortChanges(self, changes, journal):
 		trashed, existingFolders, newFolders, files = [], [], [], []
 
-		for change in changes:
+		for change in coalesceChanges(changes):
 			item = change["file"]
+			item["changeTime"] = change.get("time")
+
+			if (item["id"], item["changeTime"]) in journal:
+				continue
 
 			if item["trashed"]:
-				trashed.append(item)
+
+				# created and trashed since the last pass > there's nothing local to remove
+				if item["mimeType"] == "application/vnd.google-apps.folder":
+					known = self.index.getDirectory({"folder_id": item["id"]})
+				else:
+					known = self.cache.getFile({"file_id": item["id"]})
+
+				if known:
+					trashed.append(item)
+
 				continue
 
 			item["name"] = removeProhibitedFSchars(item["name"])
 
 			if item["mimeType"] == "application/vnd.google-apps.folder":
-				cachedDirectory = self.cache.getDirectory({"folder_id": item["id"]})
+				cachedDirectory = self.index.getDirectory({"folder_id": item["id"]})
 
 				if cachedDirectory:
 					existingFolders.append(item)
@@ -404,4 +515,4 @@ class Syncer:
 			else:
 				files.append(item)
 
-		return trashed + existingFolders + newFolders + files
+		return trashed + sortByDepth(existingFolders) + sortByDepth(newFolders) + files
@@ -7,14 +7,17 @@ import traceback
 import xbmc
 
 from .syncer import Syncer
+from .drive_scheduler import DriveScheduler
+from .task_scheduler import TaskScheduler
 from .sync_cache_manager import SyncCacheManager
 from ..filesystem.folder import Folder
 from ..encryption.encryptor import Encryptor
-from ..threadpool.threadpool import ThreadPool
+from ..network import http_requester
+from ..threadpool.threadpool import PRIORITY_LOW, ThreadPool, setMaxWorkers
 from ..google_api.google_drive import GoogleDrive
 from ..ui.dialogs import Dialog, SyncProgressionDialog
 from ..filesystem.file_operations import FileOperations
-from helpers import getCurrentTime, strToDatetime
+from helpers import strToDatetime
 
 
 class TaskManager:
@@ -23,15 +26,15 @@ class TaskManager:
 		self.settings = settings
 		self.accountManager = accountManager
 		self.accounts = self.accountManager.accounts
-		self.cloudService = GoogleDrive()
 		self.encryptor = Encryptor(settings=self.settings)
 		self.cache = SyncCacheManager()
-		self.fileOperations = FileOperations(cloud_service=self.cloudService, encryption=self.encryptor)
-		self.syncer = Syncer(self.accountManager, self.cloudService, self.encryptor, self.fileOperations, self.settings, self.cache)
+		self.scheduler = DriveScheduler()
 		self.monitor = xbmc.Monitor()
+		self.taskScheduler = TaskScheduler(self.monitor)
 		self.dialog = Dialog()
-		self.taskLock = threading.Lock()
 		self.idLock = threading.Lock()
+		self.syncerLock = threading.Lock()
+		self.syncers = {}
 		self.tasks = {}
 		self.ids = []
 		self.activeTasks = []
@@ -42,17 +45,19 @@ class TaskManager:
 		self.accountManager.setAccounts()
 		self.accounts = self.accountManager.accounts
 		account = self.accountManager.getAccount(driveID)
-		self.cloudService.setAccount(account)
-		self.cloudService.refreshToken()
+		syncer = self._getSyncer(driveID)
+		cloudService = syncer.cloudService
+		cloudService.setAccount(account)
+		cloudService.refreshToken()
 		syncRootPath = self.cache.getSyncRootPath()
 
 		if not os.path.exists(syncRootPath):
-			self.fileOperations.createDirs(syncRootPath)
+			syncer.fileOperations.createDirs(syncRootPath)
 
 		driveSettings = self.cache.getDrive(driveID)
 		drivePath = os.path.join(syncRootPath, driveSettings["local_path"])
 		folderTotal = len(folders)
-		threadCount = self.settings.getSettingInt("thread_count", 1)
+		self._setLimits()
 
 		if self.settings.getSetting("sync_progress_dialog"):
 			progressDialog = SyncProgressionDialog(folderTotal)
@@ -60,9 +65,9 @@ class TaskManager:
 		else:
 			progressDialog = None
 
-		with self.taskLock:
+		with self.scheduler.slot(driveID, self._getSyncPaths(driveID)):
 
-			with ThreadPool(threadCount) as pool:
+			with ThreadPool(PRIORITY_LOW) as pool:
 
 				for folder in folders:
 					folderID = folder["id"]
@@ -71,15 +76,18 @@ class TaskManager:
 					modifiedTime = folder["modifiedTime"]
 					folderSettings = self.cache.getFolder({"folder_id": folderID})
 					folder = Folder(folderID, folderID, folderID, driveID, folderName, dirPath, os.path.join(drivePath, dirPath), syncRootPath, folderSettings["folder_renaming"], modifiedTime)
-					pool.submit(self.syncer.syncFolderAdditions, syncRootPath, drivePath, folder, folderSettings, progressDialog)
+					pool.submit(syncer.syncFolderAdditions, syncRootPath, drivePath, folder, folderSettings, progressDialog)
 
 		if progressDialog:
 			progressDialog.close()
 
+		# a folder whose listing failed is only partly on disk
+		completed = not any(future.cancelled() or future.exception() for future in pool.futures)
+
 		if not driveSettings["page_token"]:
-			self.cache.updateDrive({"page_token": self.cloudService.getPageToken()}, driveID)
+			self.cache.updateDrive({"page_token": cloudService.getPageToken()}, driveID)
 
-		self.dialog.notification(self.settings.getLocalizedString(30000), self.settings.getLocalizedString(30044))
+		self.dialog.notification(self.settings.getLocalizedString(30000), self.settings.getLocalizedString(30044 if completed else 30222))
 		self.spawnTask(driveSettings, startUpRun=False)
 		self.activeTasks.remove(driveID)
 
@@ -92,7 +100,9 @@ class TaskManager:
 	def removeTask(self, driveID):
 
 		if driveID in self.tasks:
-			del self.tasks[driveID]
+			taskID = self.tasks.pop(driveID)
+			self.taskScheduler.cancel(taskID)
+			self.ids.remove(taskID)
 
 			while driveID in self.activeTasks:
 				time.sleep(0.1)
@@ -112,6 +122,12 @@ class TaskManager:
 		startupSync = driveSettings["startup_sync"]
 		driveID = driveSettings["drive_id"]
 
+		# the drive's previous task would otherwise keep syncing alongside the new one
+		if driveID in self.tasks:
+			taskID = self.tasks.pop(driveID)
+			self.taskScheduler.cancel(taskID)
+			self.ids.remove(taskID)
+
 		if taskMode == "manual":
 
 			if startUpRun and startupSync:
@@ -122,22 +138,27 @@ class TaskManager:
 		taskFrequency = driveSettings["task_frequency"]
 		taskID = self._createTaskID()
 		self.tasks[driveID] = taskID
+		runNow = startUpRun and startupSync
 
 		if taskMode == "schedule":
 			taskFrequency = strToDatetime(taskFrequency.lstrip())
-			threading.Thread(target=self._startScheduledTask, args=(startupSync, taskFrequency, driveID, taskID, startUpRun)).start()
+			self.taskScheduler.addDailyTask(taskID, lambda: self.sync(driveID), taskFrequency, runNow)
 		else:
 			taskFrequency = int(taskFrequency) * 60
-			threading.Thread(target=self._startIntervalTask, args=(startupSync, taskFrequency, driveID, taskID, startUpRun)).start()
+			self.taskScheduler.addIntervalTask(taskID, lambda: self.sync(driveID), taskFrequency, runNow)
+
+	def stop(self):
+		self.taskScheduler.stop()
 
 	def sync(self, driveID):
 		self.activeTasks.append(driveID)
 		synced = False
+		self._setLimits()
 
 		try:
 
-			with self.taskLock:
-				synced = self.syncer.syncChanges(driveID)
+			with self.scheduler.slot(driveID, self._getSyncPaths(driveID)):
+				synced = self._getSyncer(driveID).syncChanges(driveID)
 
 		except Exception as e:
 			xbmc.log(f"gdrive error: {e}: {''.join(traceback.format_tb(e.__traceback__))}", xbmc.LOGERROR)
@@ -147,8 +168,13 @@ class TaskManager:
 
 	def syncAll(self):
 		drives = self.cache.getDrives()
+		synced = {}
+		# plain threads as they mostly wait on the scheduler, which decides how many of them actually run at once
+		threads = [threading.Thread(target=self._syncDrive, args=(drive["drive_id"], synced)) for drive in drives]
+		[thread.start() for thread in threads]
+		[thread.join() for thread in threads]
 
-		if all(self.sync(drive["drive_id"]) for drive in drives):
+		if all(synced.get(drive["drive_id"]) for drive in drives):
 			return True
 
 	def _createTaskID(self):
@@ -162,50 +188,38 @@ class TaskManager:
 			self.ids.append(id)
 			return id
 
-	def _startIntervalTask(self, startupSync, taskFrequency, driveID, taskID, startUpRun=True):
-		lastUpdate = time.time()
-
-		while not self.monitor.abortRequested():
-
-			if self.tasks.get(driveID) != taskID:
-				self.ids.remove(taskID)
-				return
-
-			if not startupSync and startUpRun:
-				startUpRun = False
-				continue
-
-			if time.time() - lastUpdate < taskFrequency and not startUpRun:
-
-				if self.monitor.waitForAbort(1):
-					break
-
-				continue
-
-			startUpRun = False
-			self.sync(driveID)
-			lastUpdate = time.time()
-
-	def _startScheduledTask(self, startupSync, taskFrequency, driveID, taskID, startUpRun=True):
-
-		while not self.monitor.abortRequested():
+	def _getSyncPaths(self, driveID):
+		syncRootPath = self.cache.getSyncRootPath()
+		driveSettings = self.cache.getDrive(driveID)
+		paths = [os.path.join(syncRootPath, driveSettings["local_path"])]
 
-			if self.tasks.get(driveID) != taskID:
-				self.ids.remove(taskID)
-				return
+		# folder renaming moves files into directories that are shared by every drive
+		if any(folder["folder_renaming"] for folder in self.cache.getFolders({"drive_id": driveID}) or []):
+			paths += [os.path.join(syncRootPath, "[gDrive] Movies"), os.path.join(syncRootPath, "[gDrive] Series")]
 
-			if not startupSync and startUpRun:
-				startUpRun = False
-				continue
+		return paths
 
-			currentTime = getCurrentTime()
+	def _getSyncer(self, driveID):
+		# every drive gets its own syncer and drive client as both hold per pass state
 
-			if currentTime != taskFrequency and not startUpRun:
+		with self.syncerLock:
+			syncer = self.syncers.get(driveID)
 
-				if self.monitor.waitForAbort(1):
-					break
+			if not syncer:
+				cloudService = GoogleDrive()
+				fileOperations = FileOperations(cloud_service=cloudService, encryption=self.encryptor)
+				syncer = self.syncers[driveID] = Syncer(self.accountManager, cloudService, self.encryptor, fileOperations, self.settings, self.cache)
 
-				continue
+			return syncer
 
-			startUpRun = False
-			self.sync(driveID)
+	def _setLimits(self):
+		concurrency = self.settings.getSettingInt("sync_concurrency", 2)
+		threadCount = self.settings.getSettingInt("thread_count", 1)
+		self.scheduler.setMaxConcurrent(concurrency)
+		# every stage of every running drive shares the one executor > streams that are playing get room for their
+		# parallel range fetches on top
+		setMaxWorkers(threadCount * concurrency + self.settings.getSettingInt("stream_connections", 1))
+		http_requester.setPoolSize(threadCount * concurrency)
+
+	def _syncDrive(self, driveID, synced):
+		synced[driveID] = self.sync(driveID)
@@ -0,0 +1,114 @@
+import time
+import heapq
+import datetime
+import threading
+import traceback
+
+import xbmc
+
+
+class TaskScheduler:
+	# One thread sleeps until the earliest due task and starts it on its own thread. A task is rescheduled
+	# when its run ends, so runs of the same task never overlap. A daily slot that passed while the task was
+	# still running is caught up right away.
+
+	def __init__(self, monitor=None):
+		self.monitor = monitor or xbmc.Monitor()
+		self.condition = threading.Condition()
+		self.heap = []
+		self.tasks = {}
+		self.stopped = False
+		self.thread = None
+
+	def addDailyTask(self, taskID, func, timeOfDay, runNow=False):
+		self._add(taskID, {"func": func, "time": timeOfDay}, runNow)
+
+	def addIntervalTask(self, taskID, func, interval, runNow=False):
+		self._add(taskID, {"func": func, "interval": interval}, runNow)
+
+	def cancel(self, taskID):
+
+		with self.condition:
+			# the heap entry is dropped once it surfaces
+			self.tasks.pop(taskID, None)
+			self.condition.notify()
+
+	def stop(self):
+
+		with self.condition:
+			self.stopped = True
+			self.tasks = {}
+			self.heap = []
+			self.condition.notify()
+
+	def _add(self, taskID, task, runNow):
+		now = time.time()
+		task["running"] = False
+
+		with self.condition:
+			self.tasks[taskID] = task
+			self._schedule(taskID, now if runNow else self._getNextRun(task, now, now))
+
+			if not self.thread:
+				self.thread = threading.Thread(target=self._run, daemon=True)
+				self.thread.start()
+
+	def _execute(self, taskID, task):
+		start = time.time()
+
+		try:
+			task["func"]()
+		except Exception as e:
+			xbmc.log(f"gdrive error: {e}: {''.join(traceback.format_tb(e.__traceback__))}", xbmc.LOGERROR)
+
+		with self.condition:
+			task["running"] = False
+
+			if self.tasks.get(taskID) is task:
+				self._schedule(taskID, self._getNextRun(task, start, time.time()))
+
+	@staticmethod
+	def _getNextRun(task, start, end):
+
+		if "interval" in task:
+			return end + task["interval"]
+
+		# the first slot after the run started > if it already passed, the task is due right away
+		start = datetime.datetime.fromtimestamp(start)
+		nextRun = datetime.datetime.combine(start.date(), task["time"])
+
+		if nextRun <= start:
+			nextRun += datetime.timedelta(days=1)
+
+		return nextRun.timestamp()
+
+	def _run(self):
+
+		with self.condition:
+
+			while not self.stopped:
+
+				if not self.heap:
+					self.condition.wait()
+					continue
+
+				due, taskID = self.heap[0]
+				now = time.time()
+
+				if due > now:
+					self.condition.wait(due - now)
+					continue
+
+				heapq.heappop(self.heap)
+				task = self.tasks.get(taskID)
+
+				if not task or task["due"] != due or task["running"] or self.monitor.abortRequested():
+					continue
+
+				task["running"] = True
+				threading.Thread(target=self._execute, args=(taskID, task)).start()
+
+	def _schedule(self, taskID, due):
+		self.tasks[taskID]["due"] = due
+		heapq.heappush(self.heap, (due, taskID))
+		self.condition.notify()
@@ -1,80 +1,215 @@
 import os
-import queue
+import heapq
+import itertools
 import threading
 import traceback
+from concurrent.futures import Future
 
 import xbmc
 
+# priority lanes > listing feeds every other stage so it goes first, only a stream that's playing can't wait for it
+PRIORITY_URGENT = -1
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+# nested groups a waiting worker runs on its own stack before it blocks instead
+MAX_HELP_DEPTH = 8
 
-class ThreadPool(queue.Queue, xbmc.Monitor):
+
+class Executor:
+	# Process wide pool of long lived daemon workers that every stage submits to. Workers are started on
+	# demand up to maxWorkers and idle ones block on the condition. A worker waiting on a group runs the
+	# group's queued tasks itself meanwhile, up to MAX_HELP_DEPTH nested groups. Past that, or once nothing
+	# of the group is queued, it blocks and stops counting against maxWorkers, so nested groups can't
+	# starve the pool while the number of running tasks stays bounded.
 
 	def __init__(self, maxWorkers=None):
-		super().__init__()
+		self.maxWorkers = maxWorkers or min(32, (os.cpu_count() or 1) + 4)
+		self.workers = 0
+		self.idle = 0
+		self.blocked = 0
+		self.tasks = []
+		self.sequence = itertools.count()
+		self.condition = threading.Condition()
+		self.local = threading.local()
+		self.aborted = False
+		self.watcher = None
 
-		if not maxWorkers:
-			maxWorkers = min(32, (os.cpu_count() or 1) + 4)
+	def cancel(self):
+		# queued tasks are cancelled, running ones are left to finish on their own
 
-		self.maxWorkers = maxWorkers
-		self.tasksRemaining = {"tasks": 0}
-		self._createWorkers()
+		with self.condition:
+			tasks, self.tasks = self.tasks, []
 
-	def __enter__(self):
-		return self
+			# before waking the waiters > they'd otherwise find their futures still pending and wait again
+			for task in tasks:
+				task[2].cancel()
 
-	def __exit__(self, excType, excValue, excTraceback):
-		self._shutdown()
+			self.condition.notify_all()
 
-	def map(self, func, args):
-		self._setTasks(len(args))
-		[self.put((func, args_)) for args_ in args]
+	def notify(self):
 
-	def submit(self, func, *args):
-		self._incrementTasks()
-		self.put((func, args))
+		with self.condition:
+			self.condition.notify_all()
 
-	def _createWorkers(self):
-		[threading.Thread(target=self._worker).start() for _ in range(self.maxWorkers)]
+	def setMaxWorkers(self, maxWorkers):
 
-	def _decrementTasks(self):
-		self.tasksRemaining["tasks"] -= 1
+		with self.condition:
+			self.maxWorkers = max(1, maxWorkers)
+			self.condition.notify_all()
 
-	def _incrementTasks(self):
-		self.tasksRemaining["tasks"] += 1
+	def submit(self, func, *args, priority=PRIORITY_NORMAL, group=None):
+		future = Future()
 
-	def _setTasks(self, taskNumber):
-		self.tasksRemaining["tasks"] = taskNumber
+		with self.condition:
 
-	def _shutdown(self):
+			if self.aborted:
+				future.cancel()
+				return future
 
-		while self.tasksRemaining["tasks"] and not self.abortRequested():
+			heapq.heappush(self.tasks, (priority, next(self.sequence), future, func, args, group))
+			self._startWorker()
 
-			if self.waitForAbort(0.1):
-				break
+			if not self.watcher:
+				self.watcher = threading.Thread(target=self._watchAbort, daemon=True)
+				self.watcher.start()
 
-		self.put(None)
+			self.condition.notify_all()
 
-	def _worker(self):
+		return future
 
-		while not self.abortRequested():
+	def wait(self, futures, group=None):
+		worker = getattr(self.local, "worker", False)
+		depth = getattr(self.local, "depth", 0)
+		helping = worker and group is not None and depth < MAX_HELP_DEPTH
 
-			try:
-				data = self.get_nowait()
+		for future in futures:
 
-				if data is None:
-					self.put(None)
-					return
+			while not future.done():
+				task = None
 
-				func, args = data
-				func(*args)
+				with self.condition:
 
-			except queue.Empty:
+					if helping:
+						task = self._takeTask(group)
 
-				if self.waitForAbort(0.1):
-					return
+					if not task and not future.done():
+
+						if worker:
+							# another worker takes over this one's slot while it's blocked
+							self.blocked += 1
+							self._startWorker()
+
+						self.condition.wait()
+
+						if worker:
+							self.blocked -= 1
+
+				if task:
+					self.local.depth = depth + 1
 
-				continue
+					try:
+						self._run(task)
+					finally:
+						self.local.depth = depth
 
+	def _run(self, task):
+		future, func, args = task[2:5]
+
+		if future.set_running_or_notify_cancel():
+
+			try:
+				future.set_result(func(*args))
 			except Exception as e:
 				xbmc.log(f"gdrive error: {e}: {''.join(traceback.format_tb(e.__traceback__))}", xbmc.LOGERROR)
+				future.set_exception(e)
+
+		with self.condition:
+			self.condition.notify_all()
+
+	def _startWorker(self):
+
+		if len(self.tasks) > self.idle and self.workers - self.blocked < self.maxWorkers:
+			self.workers += 1
+			threading.Thread(target=self._worker, daemon=True).start()
+
+	def _takeTask(self, group):
+		# the group's next queued task > other groups' work stays queued for the workers
+		task = min((task for task in self.tasks if task[5] is group), key=lambda task: task[:2], default=None)
+
+		if task:
+			self.tasks.remove(task)
+			heapq.heapify(self.tasks)
+
+		return task
+
+	def _watchAbort(self):
+		xbmc.Monitor().waitForAbort()
+
+		with self.condition:
+			self.aborted = True
+
+		self.cancel()
+
+	def _worker(self):
+		self.local.worker = True
+
+		while True:
+
+			with self.condition:
+
+				while not self.tasks and self.workers - self.blocked <= self.maxWorkers:
+					self.idle += 1
+					self.condition.wait()
+					self.idle -= 1
+
+				if self.workers - self.blocked > self.maxWorkers:
+					self.workers -= 1
+					return
+
+				task = heapq.heappop(self.tasks)
+
+			self._run(task)
+
+
+EXECUTOR = Executor()
+
+
+class ThreadPool:
+	# a group of tasks on the shared executor > leaving the block waits for the group's tasks only, including
+	# tasks that running tasks add to the group
+
+	def __init__(self, priority=PRIORITY_NORMAL):
+		self.priority = priority
+		self.futures = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, excTraceback):
+		self.shutdown()
+
+	def cancel(self):
+
+		for future in self.futures:
+			future.cancel()
+
+		# waiters on the group only see the cancellation once they're woken
+		EXECUTOR.notify()
+
+	def map(self, func, args):
+		return [self.submit(func, *args_) for args_ in args]
+
+	def shutdown(self, wait=True):
+
+		if wait:
+			EXECUTOR.wait(self.futures, self)
+
+	def submit(self, func, *args):
+		future = EXECUTOR.submit(func, *args, priority=self.priority, group=self)
+		self.futures.append(future)
+		return future
+
 
-			self._decrementTasks()
+def setMaxWorkers(size):
+	EXECUTOR.setMaxWorkers(size)
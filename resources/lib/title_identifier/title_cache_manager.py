@@ -13,7 +13,7 @@ class TitleCacheManager(DatabaseManager):
 
 	def __init__(self):
 		newDB = not os.path.exists(CACHE_PATH)
-		super().__init__(CACHE_PATH)
+		super().__init__(CACHE_PATH, walMode=True)
 
 		if newDB:
 			self._createTables()